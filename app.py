@@ -21,16 +21,22 @@ MODEL_CHOICES = vampnet.list_hub_models()
 # load the audio tokenizer
 codec = vampnet.load_codec()
 
-# load the default pretrained model
-model = vampnet.load_model(MODEL_CHOICES[0])
-CURRENT_MODEL = MODEL_CHOICES[0]
-
-# put them into an interface
-interface = vampnet.interface.Interface(codec, model)
-
 OUT_DIR = Path("gradio-outputs")
 OUT_DIR.mkdir(exist_ok=True, parents=True)
 
+# keep a few models loaded at once, sharing the codec
+# (encoded uploads are cached on disk, so re-vamping the same file skips the encoder)
+MAX_LOADED_MODELS = 2
+pool = vampnet.interface.ModelPool(
+    codec, 
+    max_models=MAX_LOADED_MODELS, 
+    encode_cache=vampnet.interface.EncodeCache(cache_dir=OUT_DIR / "token-cache"),
+)
+
+# load the default pretrained model, and the rest in the background
+pool.get(MODEL_CHOICES[0])
+pool.preload(MODEL_CHOICES[1:])
+
 MAX_DURATION_S = 10
 def load_audio(file):
     print(file)
@@ -61,12 +67,7 @@ def _vamp(data, return_mask=False):
 
     sig = at.AudioSignal(data[input_audio])
 
-    global CURRENT_MODEL, interface
-    if data[model_choice] != CURRENT_MODEL:
-        CURRENT_MODEL = data[model_choice]
-        print(f"reloading to {data[model_choice]}")
-        model = vampnet.load_model(data[model_choice])
-        interface = vampnet.interface.Interface(codec, model)
+    interface = pool.get(data[model_choice])
 
     _seed = data[seed] if data[seed] > 0 else None
 
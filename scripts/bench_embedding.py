@@ -0,0 +1,96 @@
+"""
+benchmark CodebookEmbedding.from_codes against the old per-codebook loop,
+for the shapes we see in a generate step and in a train_loop step.
+
+python scripts/bench_embedding.py --device cuda --iters 100
+"""
+import time
+
+import torch
+import torch.nn.functional as F
+
+import vampnet
+from vampnet.model.layers import CodebookEmbedding
+
+
+def from_codes_loop(emb: CodebookEmbedding, codes: torch.Tensor, codec):
+    # the old implementation, rebuilds the lookup table for every codebook, every call
+    latent = []
+    for i in range(codes.shape[1]):
+        c = codes[:, i, :]
+        if torch.any(codes < emb.vocab_size):
+            lookup_table = codec.quantizer.quantizers[i].codebook.weight
+            special_lookup = torch.cat(
+                [emb.special[tkn][i : i + 1] for tkn in emb.special], dim=0
+            )
+            lookup_table = torch.cat([lookup_table, special_lookup], dim=0)
+            latent.append(F.embedding(c, lookup_table).transpose(1, 2))
+    return torch.cat(latent, dim=1)
+
+
+def timeit(fn, iters: int, device: str, backward: bool = False):
+    def run():
+        out = fn()
+        if backward:
+            out.sum().backward()
+
+    for _ in range(3):
+        run()
+    if "cuda" in device:
+        torch.cuda.synchronize()
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        run()
+    if "cuda" in device:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t0) / iters
+
+
+def main(device: str = vampnet.DEVICE, iters: int = 100):
+    codec = vampnet.load_codec().to(device).eval()
+    n_codebooks = vampnet.N_CODEBOOKS
+    emb = CodebookEmbedding(
+        vocab_size=vampnet.VOCAB_SIZE,
+        latent_dim=vampnet.LATENT_DIM,
+        n_codebooks=n_codebooks,
+        emb_dim=vampnet.EMBEDDING_DIM,
+        special_tokens=["MASK"],
+    ).to(device)
+    mask_token = emb.special_idxs["MASK"]
+
+    # number of sampling steps in a default generate call
+    n_gen_steps = sum(([16, 4, 4, 2, 2, 2, 2, 1, 1] + [1] * n_codebooks)[:n_codebooks])
+
+    settings = {
+        # generate: one item, a full context, no grad
+        "generate": dict(batch_size=1, seq_len=vampnet.MAX_SEQ_LEN, grad=False),
+        # train_loop: a full batch, with gradients flowing into the special tokens
+        "train_loop": dict(batch_size=vampnet.BATCH_SIZE, seq_len=vampnet.SEQ_LEN, grad=True),
+    }
+    for name, cfg in settings.items():
+        codes = torch.randint(
+            0, vampnet.VOCAB_SIZE, (cfg["batch_size"], n_codebooks, cfg["seq_len"]),
+            device=device
+        )
+        codes = codes.masked_fill(torch.rand_like(codes, dtype=torch.float) < 0.5, mask_token)
+        assert torch.equal(emb.from_codes(codes, codec), from_codes_loop(emb, codes, codec))
+
+        with torch.set_grad_enabled(cfg["grad"]):
+            t_loop = timeit(lambda: from_codes_loop(emb, codes, codec), iters, device, cfg["grad"])
+            t_fused = timeit(lambda: emb.from_codes(codes, codec), iters, device, cfg["grad"])
+
+        print(f"{name} (batch {cfg['batch_size']}, seq {cfg['seq_len']}):")
+        print(f"  loop:  {t_loop * 1e3:.3f} ms/step")
+        print(f"  fused: {t_fused * 1e3:.3f} ms/step")
+        print(f"  saved: {(t_loop - t_fused) * 1e3:.3f} ms/step ({t_loop / t_fused:.2f}x)")
+        if name == "generate":
+            print(f"  saved per generate call ({n_gen_steps} steps): {(t_loop - t_fused) * n_gen_steps * 1e3:.3f} ms")
+
+
+if __name__ == "__main__":
+    import yapecs
+    parser = yapecs.ArgumentParser()
+    parser.add_argument("--device", type=str, default=vampnet.DEVICE, help="device to benchmark on")
+    parser.add_argument("--iters", type=int, default=100, help="number of timed iterations")
+    args = parser.parse_args()
+    main(**vars(args))
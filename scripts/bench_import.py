@@ -0,0 +1,92 @@
+"""
+import-time report for vampnet, in the style of `python -X importtime`.
+
+runs a fresh interpreter for each scenario, reports the slowest imports
+and checks that the inference-only cold start stays within budget,
+and doesn't pull in any training or database dependencies.
+
+python scripts/bench_import.py --budget 8.0
+"""
+import subprocess
+import sys
+import time
+
+# what an inference-only process imports
+INFERENCE = "import vampnet; vampnet.interface; vampnet.load_codec"
+
+SCENARIOS = {
+    "config only": "import vampnet",
+    "inference": INFERENCE,
+    "everything": "import vampnet; vampnet.interface; vampnet.db; vampnet.train; vampnet.export",
+}
+
+# modules an inference-only process should never import. 
+# (not tensorboard: `import audiotools` always imports audiotools.ml, 
+# which imports SummaryWriter, and inference can't do without AudioSignal)
+FORBIDDEN = [
+    "vampnet.train", "vampnet.fine_tune", "vampnet.export", "vampnet.db",
+    "duckdb",
+]
+
+
+def run(code: str):
+    """runs `code` in a fresh interpreter, returns wall time, importtime rows and imported modules"""
+    code = f"{code}; import sys; print('\\n'.join(sys.modules))"
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - t0
+    if proc.returncode != 0:
+        stderr = "\n".join(l for l in proc.stderr.splitlines() if not l.startswith("import time:"))
+        raise RuntimeError(f"failed to run {code!r}:\n{stderr}")
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), int(self_us), module.rstrip()))
+    return wall, rows, set(proc.stdout.split())
+
+
+def report(name: str, wall: float, rows: list, top: int):
+    print(f"== {name}: {wall:.2f}s wall")
+    print(f"  {'cumulative [ms]':>16} {'self [ms]':>10}  module")
+    for cumulative_us, self_us, module in sorted(rows, reverse=True)[:top]:
+        print(f"  {cumulative_us / 1e3:>16.1f} {self_us / 1e3:>10.1f}  {module}")
+
+
+def main(budget: float = 8.0, top: int = 15):
+    ok = True
+    for name, code in SCENARIOS.items():
+        try:
+            wall, rows, modules = run(code)
+        except RuntimeError as e:
+            # e.g. an optional dependency of the training code isn't installed
+            print(f"== {name}: could not run")
+            print(f"  {str(e).strip().splitlines()[-1]}")
+            if code == INFERENCE:
+                ok = False
+            continue
+        report(name, wall, rows, top)
+
+        if code == INFERENCE:
+            imported = [m for m in FORBIDDEN if m in modules]
+            if imported:
+                print(f"  FAIL: inference imported {imported}")
+                ok = False
+            if wall > budget:
+                print(f"  FAIL: inference cold start took {wall:.2f}s, budget is {budget:.2f}s")
+                ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", type=float, default=8.0, help="cold start budget for an inference-only process, in seconds")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to show")
+    args = parser.parse_args()
+    sys.exit(0 if main(**vars(args)) else 1)
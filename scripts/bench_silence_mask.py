@@ -0,0 +1,67 @@
+"""
+benchmark the vectorized silence mask in Interface.decode against 
+the old per-timestep loop, at 10s, 60s and 5min.
+
+python scripts/bench_silence_mask.py --device cuda --iters 10
+"""
+import time
+
+import torch
+
+import vampnet
+from vampnet.interface import apply_silence_mask
+
+
+def silence_mask_loop(samples, z, mask_token, hop_length):
+    # the old implementation, one check + write per timestep, across the whole batch
+    samples = samples.clone()
+    for tstep in range(z.shape[-1]):
+        if torch.any(z[:, :, tstep] == mask_token):
+            sample_idx_0 = tstep * hop_length
+            sample_idx_1 = sample_idx_0 + hop_length
+            samples[:, :, sample_idx_0:sample_idx_1] = 0.0
+    return samples
+
+
+def timeit(fn, iters: int, device: str):
+    fn()
+    if "cuda" in device:
+        torch.cuda.synchronize()
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if "cuda" in device:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t0) / iters
+
+
+def main(device: str = vampnet.DEVICE, iters: int = 10, batch_size: int = 1):
+    mask_token = vampnet.VOCAB_SIZE
+    hop_length = vampnet.HOP_SIZE
+
+    for duration in (10, 60, 300):
+        n_frames = int(duration * vampnet.SAMPLE_RATE / hop_length)
+        z = torch.randint(0, vampnet.VOCAB_SIZE, (batch_size, vampnet.N_CODEBOOKS, n_frames), device=device)
+        z = z.masked_fill(torch.rand(z.shape, device=device) < 0.1, mask_token)
+        samples = torch.randn(batch_size, 1, n_frames * hop_length, device=device)
+
+        if batch_size == 1:
+            # the loop masks across the batch, so they only agree for a single item
+            assert torch.equal(
+                silence_mask_loop(samples, z, mask_token, hop_length),
+                apply_silence_mask(samples, z, mask_token, hop_length),
+            )
+
+        t_loop = timeit(lambda: silence_mask_loop(samples, z, mask_token, hop_length), iters, device)
+        t_vec = timeit(lambda: apply_silence_mask(samples, z, mask_token, hop_length), iters, device)
+        print(f"{duration}s ({n_frames} frames): loop {t_loop * 1e3:.2f} ms, vectorized {t_vec * 1e3:.2f} ms ({t_loop / t_vec:.1f}x)")
+
+
+if __name__ == "__main__":
+    import yapecs
+    parser = yapecs.ArgumentParser()
+    parser.add_argument("--device", type=str, default=vampnet.DEVICE, help="device to benchmark on")
+    parser.add_argument("--iters", type=int, default=10, help="number of timed iterations")
+    parser.add_argument("--batch_size", type=int, default=1, help="batch size")
+    args = parser.parse_args()
+    main(**vars(args))
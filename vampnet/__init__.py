@@ -23,20 +23,38 @@ from .config.static import *
 ###############################################################################
 
 
-# Your imports go here
-from . import controls
-from .controls.codec import load_codec
-from .model import transformer
-from . import interface
-from . import db
-from . import util
-from . import export
-from . import train
-from . import fine_tune
-from . import mask
+# submodules are imported lazily, on first attribute access, 
+# so that `import vampnet` only resolves our configuration. 
+# (e.g. an inference process never has to import train, db or export)
+import importlib
+
+_LAZY_SUBMODULES = {
+    "controls", "interface", "db", "util", "export", "train", "fine_tune", "mask", "model",
+}
+_LAZY_ATTRS = {
+    # name: (submodule, attribute)
+    "load_codec": ("controls.codec", "load_codec"),
+    "transformer": ("model.transformer", None),
+    "Interface": ("interface", "Interface"),
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    if name in _LAZY_ATTRS:
+        module_name, attr = _LAZY_ATTRS[name]
+        value = importlib.import_module(f".{module_name}", __name__)
+        if attr is not None:
+            value = getattr(value, attr)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | _LAZY_SUBMODULES | set(_LAZY_ATTRS))
 
-from pathlib import Path
-from huggingface_hub import hf_hub_download
 
 # TODO: load dac should download dac
 # TODO: fix COLAB NOTEBOOK NT WORKING
@@ -46,11 +64,14 @@ from huggingface_hub import hf_hub_download
 HF_MODELS = ["hugggof/vampnet-models:vampnet-base-best"]
 # download a model from the huggingface hub
 def load_hub_model(model_id = HF_MODELS[0]):
+    from huggingface_hub import hf_hub_download
+    from .model import transformer
+
     repo_id, model_name = model_id.split(":")
     # download the model
-    filename = Path(model_name).with_suffix(vampnet.MODEL_EXT)
+    filename = Path(model_name).with_suffix(MODEL_EXT)
     # filename = vampnet.MODEL_FILE.name
-    subfolder = vampnet.MODEL_FILE.parent.relative_to(vampnet.ROOT)
+    subfolder = MODEL_FILE.parent.relative_to(ROOT)
     model_dir = hf_hub_download(
         repo_id,
         filename=filename,
@@ -67,11 +88,12 @@ def list_hub_models():
 
 def list_local_models():
     # list all .vampnet files in the models directory
-    return [p.stem for p in MODELS_DIR.glob(f'*{vampnet.MODEL_EXT}')]
-    pass
+    return [p.stem for p in MODELS_DIR.glob(f'*{MODEL_EXT}')]
 
 
 def load_local_model(name):
+    from .model import transformer
+
     # load a model by name
     ckpt = MODELS_DIR / f"{name}.vampnet"
     return transformer.VampNet.load(ckpt)
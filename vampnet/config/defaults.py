@@ -76,6 +76,11 @@ SEQ_LEN = 512
 DATASET = "anns-animals"
 CODES_KEY = "dac"
 CTRL_KEYS = []
+DATASET_BACKEND = "files" # or "shards", see vampnet.db.shard
+PACK_CODES = False # store cached codes at 10 bits per token, see vampnet.controls.packing
+COMPACT_BATCHES = False # keep batches int16 until they're on the device, see VampNetDataset
+SEQUENCE_PACKING = False # pack short files into one window instead of padding, see VampNetDataset
+VAL_SAMPLING = "per_file" # one window per val file. "exhaustive" validates on every window (slower), see VampNetDataset
 
 TRAIN_PROPORTION = 0.8
 VAL_PROPORTION = 0.1
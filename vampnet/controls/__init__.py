@@ -11,6 +11,14 @@ import vampnet
 
 SUFFIX = ".ctrl"
 
+# the ctrl array is stored as a raw, uncompressed, time-major .npy file,
+# so that we can memory map it and only read the frames we need
+CTRL_FILE = "ctrl.npy"
+# older caches stored it in a (compressed) npz archive, which can't be memory mapped
+LEGACY_CTRL_FILE = "ctrl.npz"
+# or, for token controls, 10-bit packed. see vampnet.controls.packing
+PACKED_CTRL_FILE = "ctrl.p10"
+
 class Control:
     name: str 
     ctrl: torch.Tensor
@@ -18,6 +26,11 @@ class Control:
     @classmethod
     def from_signal(cls, sig: AudioSignal):
         raise NotImplementedError()
+
+    @classmethod
+    def from_signals(cls, sigs: List[AudioSignal]) -> List["Control"]:
+        # extractors that can batch across signals should override this
+        return [cls.from_signal(sig) for sig in sigs]
     
     @property
     def num_frames(self):
@@ -40,8 +53,10 @@ class Control:
         assert self.ctrl.ndim == 3
 
 
-    def save(self, path: str):
-        # use np.savez, pack dict(**vars(self)) into a metadata dict
+    def save(self, path: str, packed: bool = False):
+        # use np.save, pack dict(**vars(self)) into a metadata dict
+        # if packed, the ctrl must be integer tokens in [0, 1024), 
+        # and we store them at 10 bits per token.
         num_frames = self.ctrl.shape[-1]
         num_channels = self.ctrl.shape[-2]
 
@@ -52,9 +67,13 @@ class Control:
         }
         metadata.update(dict(**vars(self)))
         metadata.pop("ctrl")
+        if packed:
+            # we need the full time-major shape and dtype to unpack
+            metadata['packed_shape'] = [num_frames, *self.ctrl.shape[:-1]]
+            metadata['packed_dtype'] = str(self.ctrl.numpy().dtype)
 
         # lets make a folder with an extension
-        # the ctrl array we'll save as an npz file inside the folder
+        # the ctrl array we'll save as an npy file inside the folder
         # and the metadata we'll save as a json file inside the folder
         path = Path(path)
         path.mkdir(parents=True, exist_ok=True)
@@ -64,15 +83,28 @@ class Control:
         ctrl = self.ctrl.numpy()
         # make the array time first and contiguous
         ctrl = np.ascontiguousarray(ctrl.transpose(2, 0, 1))
-        np.savez(path / "ctrl.npz", ctrl=ctrl)
+        if packed:
+            from vampnet.controls import packing
+            packing.pack(ctrl).tofile(path / PACKED_CTRL_FILE)
+            (path / CTRL_FILE).unlink(missing_ok=True)
+        else:
+            np.save(path / CTRL_FILE, ctrl)
+            (path / PACKED_CTRL_FILE).unlink(missing_ok=True)
 
     
     @classmethod
     def load(cls, path: str, offset: int = 0, num_frames: int = None):
         path = Path(path)
-        # TODO: this is supposed to be fast lookup for slices, but it takes just as long. 
-        # could it be a memory layout thing? 
-        ctrl = np.load(path / "ctrl.npz", mmap_mode="r")['ctrl']
+        if (path / PACKED_CTRL_FILE).exists():
+            return cls._load_packed(path, offset, num_frames)
+
+        if (path / CTRL_FILE).exists():
+            # memory map, so we only read the pages for the frames we slice
+            ctrl = np.load(path / CTRL_FILE, mmap_mode="r")
+        else:
+            # mmap_mode is ignored for npz, so this reads the whole thing.
+            # run `python -m vampnet.controls.migrate` to convert old caches.
+            ctrl = np.load(path / LEGACY_CTRL_FILE)['ctrl']
         metadata = cls.load_metadata(path)
 
         num_frames = num_frames or metadata['num_frames']
@@ -81,12 +113,36 @@ class Control:
         metadata.pop("num_frames")
         metadata.pop("num_channels")
 
-        out = torch.from_numpy(ctrl[offset:offset+num_frames, ...]).clone()
+        out = torch.from_numpy(np.array(ctrl[offset:offset+num_frames, ...]))
         # transpose back out
         out = out.permute(1, 2, 0).contiguous()
         return cls(ctrl=out)
 
 
+    @classmethod
+    def _load_packed(cls, path: Path, offset: int = 0, num_frames: int = None):
+        from vampnet.controls import packing
+        metadata = cls.load_metadata(path)
+        total_frames, *frame_shape = metadata['packed_shape']
+        frame_size = int(np.prod(frame_shape))
+
+        num_frames = num_frames or total_frames
+        start = min(offset, total_frames)
+        end = min(offset + num_frames, total_frames)
+
+        # memory map, and only unpack the blocks that cover our frames
+        packed = np.memmap(path / PACKED_CTRL_FILE, dtype=np.uint8, mode="r")
+        ctrl = packing.unpack_range(
+            packed, start * frame_size, end * frame_size, 
+            dtype=np.dtype(metadata['packed_dtype'])
+        )
+        ctrl = ctrl.reshape(end - start, *frame_shape)
+
+        out = torch.from_numpy(ctrl)
+        # transpose back out
+        out = out.permute(1, 2, 0).contiguous()
+        return cls(ctrl=out)
+
     @classmethod
     def load_metadata(cls, path: str):
         with open(Path(path) / "metadata.json", 'r') as f:
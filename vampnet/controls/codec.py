@@ -1,5 +1,7 @@
 
 from pathlib import Path
+import math
+from typing import List
 import torch
 import numpy as np
 import tqdm
@@ -37,66 +39,203 @@ def receptive_field(model):
     return total_size, total_stride, total_padding
 
 
+def _window_params(model, win_duration):
+    """
+    works out how to window the encoder's input, given the desired window duration.
+    returns (field_size, stride, padding, win_size, num_codes, hop_size)
+    """
+    # determine receptive field of encoder
+    model.padding = True
+    field_size, stride, padding = receptive_field(model.encoder)
+    model.padding = False
+    # determine the window size to use
+    # - the maximum samples the user wants to read at once
+    win_size = int(win_duration * model.sample_rate)
+    # - how many code frames we would get from this
+    num_codes = (win_size - field_size + stride) // stride
+    # - how many samples are actually involved in that
+    win_size = field_size + (num_codes - 1) * stride
+    # determine the hop size to use
+    hop_size = num_codes * stride
+    return field_size, stride, padding, win_size, num_codes, hop_size
+
+
+def _windows(model, audio, field_size, stride, padding, win_size, num_codes, hop_size):
+    """
+    yields the windows to encode for one signal, 
+    as (samples, number of code frames to keep). every window has win_size samples.
+    """
+    # right-pad to the next multiple of hop length
+    # (as the model's internal padding is short by one hop length)
+    remainder = audio.shape[-1] % model.hop_length
+    right_pad = model.hop_length - remainder if remainder else 0
+
+    audio_size = audio.audio_data.size(-1)
+    for start_position in tqdm.trange(-padding,
+                                      audio_size + padding + right_pad,
+                                      hop_size,
+                                      leave=False):
+        # extract chunk
+        chunk = audio[..., max(0, start_position):start_position + win_size]
+        # zero-pad the first chunk(s)
+        if start_position < 0:
+            chunk.zero_pad(-start_position, 0)
+        chunk_size = chunk.audio_data.size(-1)
+        # skip the last chunk if it would not have yielded any output
+        if chunk_size + padding + right_pad < field_size:
+            continue
+        # pad the last chunk(s) to the full window size if needed
+        if chunk_size < win_size:
+            chunk.zero_pad(0, win_size - chunk_size)
+        # remove excess frames from padding if needed
+        chunk_codes = num_codes
+        if chunk_size + padding + right_pad < win_size:
+            chunk_codes = (chunk_size + padding + right_pad - field_size + stride) // stride
+        yield chunk.audio_data, chunk_codes
+
+
 @torch.inference_mode()
-def compress(model, device, audio, win_duration, n_quantizers=None):
-    """Encodes the given audio signal, returns the codes."""
+def compress(model, device, audio, win_duration, n_quantizers=None, batch_windows=1):
+    """
+    Encodes the given audio signal, returns the codes.
+    if win_duration is given, the audio is encoded window by window, 
+    and up to batch_windows windows are stacked into a single batch for the encoder.
+    """
+    if win_duration:
+        return compress_many(
+            model, device, [audio], win_duration, n_quantizers,
+            batch_size=batch_windows * audio.audio_data.size(0)
+        )[0]
+
     # right-pad to the next multiple of hop length
     # (as the model's internal padding is short by one hop length)
     remainder = audio.shape[-1] % model.hop_length
     right_pad = model.hop_length - remainder if remainder else 0
     model.to(device)
-    if not win_duration:
-        model.padding = True
-        if right_pad:
-            audio.zero_pad(0, right_pad)
-        samples = audio.audio_data.to(device)
-        codes = model.encode(samples, n_quantizers)["codes"]
-        codes = codes.permute(2, 1, 0).short()  # -> time, quantizers, channels
-    else:
-        # determine receptive field of encoder
-        model.padding = True
-        field_size, stride, padding = receptive_field(model.encoder)
-        model.padding = False
-        # determine the window size to use
-        # - the maximum samples the user wants to read at once
-        win_size = int(win_duration * model.sample_rate)
-        # - how many code frames we would get from this
-        num_codes = (win_size - field_size + stride) // stride
-        # - how many samples are actually involved in that
-        win_size = field_size + (num_codes - 1) * stride
-        # determine the hop size to use
-        hop_size = num_codes * stride
-        # finally process the input
-        codes = []
-        audio_size = audio.audio_data.size(-1)
-        for start_position in tqdm.trange(-padding,
-                                          audio_size + padding + right_pad,
-                                          hop_size,
-                                          leave=False):
-            # extract chunk
-            chunk = audio[..., max(0, start_position):start_position + win_size]
-            # zero-pad the first chunk(s)
-            if start_position < 0:
-                chunk.zero_pad(-start_position, 0)
-            chunk_size = chunk.audio_data.size(-1)
-            # skip the last chunk if it would not have yielded any output
-            if chunk_size + padding + right_pad < field_size:
-                continue
-            # pad the last chunk(s) to the full window size if needed
-            if chunk_size < win_size:
-                chunk.zero_pad(0, win_size - chunk_size)
-            # process chunk
-            samples = chunk.audio_data.to(device)
-            c = model.encode(samples, n_quantizers)["codes"].cpu()
-            c = c.permute(2, 1, 0)  # -> time, quantizers, channels
-            # remove excess frames from padding if needed
-            if chunk_size + padding + right_pad < win_size:
-                chunk_codes = (chunk_size + padding + right_pad - field_size + stride) // stride
-                c = c[:chunk_codes]
-            codes.append(c.short())
-        codes = torch.cat(codes, dim=0)
+    model.padding = True
+    if right_pad:
+        audio.zero_pad(0, right_pad)
+    samples = audio.audio_data.to(device)
+    codes = model.encode(samples, n_quantizers)["codes"]
+    codes = codes.permute(2, 1, 0).short()  # -> time, quantizers, channels
     return codes.contiguous()
 
+
+@torch.inference_mode()
+def compress_many(model, device, audios, win_duration, n_quantizers=None, batch_size=2):
+    """
+    Encodes many audio signals at once, returns a list with the codes for each.
+    signals are sorted by length and encoded in groups. each group is windowed 
+    for its longest signal (up to win_duration), and the windows of all signals 
+    (and all of their channels) in a group are stacked into batches for the encoder. 
+    so short files get short windows instead of being padded out to win_duration, 
+    and many of them share an encoder forward. 
+
+    batch_size bounds the encoder's input to batch_size windows of win_duration, 
+    so a batch holds up to batch_size full windows, or proportionally more shorter ones. 
+    (a full ~29s window takes about 1.6GB of activations in the encoder.)
+    """
+    model.to(device)
+    full_params = _window_params(model, win_duration)
+    field_size, stride, padding, full_win_size = full_params[:4]
+    max_samples = batch_size * full_win_size
+
+    def win_size_for(audio):
+        # enough samples to encode the whole signal in one window (or a full window)
+        n = audio.audio_data.size(-1) + 2 * padding + model.hop_length
+        return min(full_win_size, max(field_size, n) + stride)
+
+    codes = [[] for _ in audios]
+    # chunks waiting to be encoded, as (signal index, samples, number of code frames to keep)
+    pending = []
+
+    def encode_pending():
+        # encode all pending chunks in a single batch
+        samples = torch.cat([p[1] for p in pending], dim=0).to(device)
+        c = model.encode(samples, n_quantizers)["codes"].cpu()
+        sizes = [p[1].size(0) for p in pending]
+        for (i, _, chunk_codes), _c in zip(pending, c.split(sizes, dim=0)):
+            _c = _c.permute(2, 1, 0)  # -> time, quantizers, channels
+            codes[i].append(_c[:chunk_codes].short())
+        pending.clear()
+
+    # shortest first, so that signals of similar length share a group
+    order = sorted(range(len(audios)), key=lambda i: audios[i].audio_data.size(-1))
+    start = 0
+    while start < len(order):
+        # grow the group while a batch of its (growing) window size still fits
+        end, rows = start + 1, audios[order[start]].audio_data.size(0)
+        while end < len(order):
+            audio = audios[order[end]]
+            if win_size_for(audio) == full_win_size:
+                break
+            if (rows + audio.audio_data.size(0)) * win_size_for(audio) > max_samples:
+                break
+            rows += audio.audio_data.size(0)
+            end += 1
+        group = order[start:end]
+        start = end
+
+        win_size = win_size_for(audios[group[-1]])
+        if win_size < full_win_size:
+            params = _window_params(model, win_size / model.sample_rate)
+        else:
+            params = full_params
+        max_rows = max(1, max_samples // params[3])
+
+        num_pending = 0
+        for i in group:
+            for samples, chunk_codes in _windows(model, audios[i], *params):
+                pending.append((i, samples, chunk_codes))
+                num_pending += samples.size(0)
+                if num_pending >= max_rows:
+                    encode_pending()
+                    num_pending = 0
+        # windows of the next group have a different size
+        if pending:
+            encode_pending()
+    return [torch.cat(c, dim=0).contiguous() for c in codes]
+
+@torch.inference_mode()
+def decompress(model, z, win_duration):
+    """
+    Decodes the given continuous latents window by window, returns the audio. 
+    each window is decoded with enough context on both sides to cover 
+    the decoder's receptive field, and the context is trimmed from the output, 
+    so the result matches a full decode while memory is bounded by the window size.
+
+    Args:
+        model: the codec.
+        z (torch.Tensor): continuous latents. shape (batch, latent_dim, frames)
+        win_duration (float): window duration in seconds. if falsy, decode everything at once.
+
+    Returns:
+        torch.Tensor: audio. shape (batch, 1, frames * hop_length)
+    """
+    model.padding = True
+    num_frames = z.shape[-1]
+    win_len = int(win_duration * model.sample_rate / model.hop_length) if win_duration else 0
+    if not win_len or num_frames <= win_len:
+        return model.decode(z)
+
+    # determine receptive field of decoder, in latent frames
+    field_size, _, _ = receptive_field(model.decoder)
+    context = math.ceil(field_size)
+
+    audio = []
+    for start in range(0, num_frames, win_len):
+        end = min(start + win_len, num_frames)
+        ctx_start = max(0, start - context)
+        ctx_end = min(num_frames, end + context)
+        y = model.decode(z[..., ctx_start:ctx_end])
+        assert y.shape[-1] == (ctx_end - ctx_start) * model.hop_length, \
+            f"expected the decoder to output {model.hop_length} samples per frame, but got {y.shape[-1]} samples for {ctx_end - ctx_start} frames"
+        # remove the context
+        y_start = (start - ctx_start) * model.hop_length
+        y_end = y_start + (end - start) * model.hop_length
+        audio.append(y[..., y_start:y_end])
+    return torch.cat(audio, dim=-1)
+
 def _load_from_hub():
     from huggingface_hub import hf_hub_download
     # repo_id, model_name = model_id.split(":")
@@ -134,24 +273,42 @@ class DACControl(vampnet.controls.Control):
     ext: str = ".dac"
     metadata: dict = None
 
+    def save(self, path: str, packed: bool = vampnet.PACK_CODES):
+        # codes fit in 10 bits, so we can pack them
+        super().save(path, packed=packed)
+
     @classmethod
     def from_signal(cls, sig: AudioSignal, device=vampnet.DEVICE):
+        return cls.from_signals([sig], device=device)[0]
 
-        from dac.model.base import DACFile
-        metadata = {}
-        metadata["original_length"] = int(sig.samples.shape[-1])
-        metadata["input_db"] = float(sig.ffmpeg_loudness())
-        metadata["win_duration"] = vampnet.HOP_SIZE * 2500 / vampnet.SAMPLE_RATE
+    @classmethod
+    def from_signals(cls, sigs: List[AudioSignal], device=vampnet.DEVICE, batch_size: int = 2):
+        """
+        encodes many signals at once. the codec windows of all signals
+        and channels are batched together, see `compress_many`.
+        """
+        win_duration = vampnet.HOP_SIZE * 2500 / vampnet.SAMPLE_RATE
+        metadatas, normalized = [], []
+        for sig in sigs:
+            metadata = {}
+            metadata["original_length"] = int(sig.samples.shape[-1])
+            metadata["input_db"] = float(sig.ffmpeg_loudness())
+            metadata["win_duration"] = win_duration
+            metadatas.append(metadata)
 
-        sig = sig.normalize(vampnet.LOUD_NORM).ensure_max_of_audio()
-        sig.samples = sig.samples.view(-1, 1, sig.samples.shape[-1])
+            # (normalize works in place, so leave the caller's signal alone)
+            sig = sig.clone().normalize(vampnet.LOUD_NORM).ensure_max_of_audio()
+            sig.samples = sig.samples.view(-1, 1, sig.samples.shape[-1])
+            normalized.append(sig)
 
-        codes = compress(
+        codes = compress_many(
                 load_codec(), 
                 device, 
-                sig,
-                win_duration=metadata["win_duration"], # like 30s 
-        ) # (nt, nch, nc
-        codes = codes.permute(2, 1, 0) # (nch, nc, nt)
-
-        return cls(codes, metadata=metadata)
\ No newline at end of file
+                normalized,
+                win_duration=win_duration, # like 30s 
+                batch_size=batch_size,
+        ) # [(nt, nch, nc)]
+        return [
+            cls(c.permute(2, 1, 0), metadata=metadata) # (nch, nc, nt)
+            for c, metadata in zip(codes, metadatas)
+        ]
\ No newline at end of file
@@ -0,0 +1,55 @@
+"""
+convert control signal caches from the old ctrl.npz format to 
+memory-mappable ctrl.npy files, in place. 
+
+python -m vampnet.controls.migrate --root data/cache/vamp.db
+"""
+from pathlib import Path
+
+import numpy as np
+import tqdm
+
+import vampnet
+from vampnet.controls import CTRL_FILE, LEGACY_CTRL_FILE
+
+
+def migrate_cache(root: str = None, keep_legacy: bool = False):
+    """
+    finds every ctrl.npz under root and replaces it with a ctrl.npy. 
+    safe to interrupt and re-run: each file is written to a temporary 
+    file first, and the npz is only removed once the npy is in place.
+    """
+    root = Path(root or vampnet.CACHE_PATH)
+    print(f"looking for {LEGACY_CTRL_FILE} files in {root}")
+    legacy_files = sorted(root.rglob(LEGACY_CTRL_FILE))
+    print(f"Found {len(legacy_files)} files to migrate")
+
+    num_failed = 0
+    for legacy_file in tqdm.tqdm(legacy_files):
+        out_file = legacy_file.parent / CTRL_FILE
+        tmp_file = legacy_file.parent / f"{CTRL_FILE}.tmp"
+        try:
+            if not out_file.exists():
+                ctrl = np.load(legacy_file)['ctrl']
+                with open(tmp_file, "wb") as f:
+                    np.save(f, np.ascontiguousarray(ctrl))
+                tmp_file.replace(out_file)
+            if not keep_legacy:
+                legacy_file.unlink()
+        except Exception as e:
+            print(f"Could not migrate {legacy_file}: {e}")
+            num_failed += 1
+
+    print(f"Migrated {len(legacy_files)} files")
+    print(f"of which {num_failed} failed")
+
+
+if __name__ == "__main__":
+    import yapecs
+    parser = yapecs.ArgumentParser()
+
+    parser.add_argument("--root", type=str, default=None, help="cache folder to migrate. defaults to vampnet.CACHE_PATH")
+    parser.add_argument("--keep_legacy", action="store_true", help="keep the old ctrl.npz files around")
+
+    args = parser.parse_args()
+    migrate_cache(**vars(args))
@@ -0,0 +1,67 @@
+"""
+10-bit packing for codec tokens.
+
+with a vocab size of 1024, every token fits in 10 bits, but we store them as int16.
+here, every block of 4 tokens is packed into 5 bytes, so a packed array
+is 5/8 the size of the int16 one. since blocks are byte aligned,
+we can unpack any range of tokens by reading only the blocks that cover it.
+"""
+import numpy as np
+
+BITS = 10
+TOKENS_PER_BLOCK = 4
+BYTES_PER_BLOCK = 5
+MAX_TOKEN = 2 ** BITS - 1
+
+_BYTE_SHIFTS = np.arange(BYTES_PER_BLOCK, dtype=np.uint64) * np.uint64(8)
+_TOKEN_SHIFTS = np.arange(TOKENS_PER_BLOCK, dtype=np.uint64) * np.uint64(BITS)
+
+
+def packed_size(num_tokens: int) -> int:
+    """number of bytes needed to pack num_tokens tokens"""
+    return -(-num_tokens // TOKENS_PER_BLOCK) * BYTES_PER_BLOCK
+
+
+def pack(tokens: np.ndarray) -> np.ndarray:
+    """
+    pack an array of tokens in [0, 1024) into a flat uint8 array.
+    the array is flattened in C order.
+    """
+    tokens = np.ascontiguousarray(tokens).reshape(-1)
+    assert tokens.size == 0 or (tokens.min() >= 0 and tokens.max() <= MAX_TOKEN), \
+        f"tokens must be in [0, {MAX_TOKEN}] to be packed in {BITS} bits"
+
+    # pad to a whole number of blocks
+    pad = -tokens.size % TOKENS_PER_BLOCK
+    tokens = np.concatenate([tokens, np.zeros(pad, dtype=tokens.dtype)])
+
+    blocks = tokens.astype(np.uint64).reshape(-1, TOKENS_PER_BLOCK)
+    blocks = np.bitwise_or.reduce(blocks << _TOKEN_SHIFTS, axis=-1)  # 40 bits per block
+    out = (blocks[:, None] >> _BYTE_SHIFTS) & np.uint64(0xFF)
+    return out.astype(np.uint8).reshape(-1)
+
+
+def unpack(packed: np.ndarray, num_tokens: int = None, dtype=np.int16) -> np.ndarray:
+    """
+    unpack a flat uint8 array made by `pack` back into a flat array of tokens.
+    """
+    packed = np.asarray(packed, dtype=np.uint8).reshape(-1, BYTES_PER_BLOCK)
+    blocks = np.bitwise_or.reduce(packed.astype(np.uint64) << _BYTE_SHIFTS, axis=-1)
+    tokens = (blocks[:, None] >> _TOKEN_SHIFTS) & np.uint64(MAX_TOKEN)
+    tokens = tokens.astype(dtype).reshape(-1)
+    if num_tokens is not None:
+        tokens = tokens[:num_tokens]
+    return tokens
+
+
+def unpack_range(packed: np.ndarray, start: int, end: int, dtype=np.int16) -> np.ndarray:
+    """
+    unpack tokens [start, end) out of a packed array,
+    only touching the blocks that cover the range. `packed` can be a memmap.
+    """
+    first_block = start // TOKENS_PER_BLOCK
+    last_block = -(-end // TOKENS_PER_BLOCK)
+    blocks = packed[first_block * BYTES_PER_BLOCK : last_block * BYTES_PER_BLOCK]
+    tokens = unpack(np.array(blocks), dtype=dtype)
+    skip = start - first_block * TOKENS_PER_BLOCK
+    return tokens[skip : skip + (end - start)]
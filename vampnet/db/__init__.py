@@ -3,4 +3,7 @@
 from .core import *
 from . import create
 from . import partition
-from . import preprocess
\ No newline at end of file
+from . import preprocess
+from . import shard
+from . import manifest
+from . import sync
@@ -2,7 +2,7 @@ import vampnet
 import duckdb
 import pandas as pd
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional
 from pathlib import Path
 
 def conn(read_only=True) -> duckdb.DuckDBPyConnection:
@@ -65,6 +65,8 @@ class AudioFile:
     num_channels: Optional[int] = None
     bit_depth: Optional[int] = None
     encoding: Optional[str] = None
+    file_size: Optional[int] = None
+    mtime: Optional[float] = None
 def create_audio_file_table(conn):
     conn.sql(
         """
@@ -82,12 +84,22 @@ def create_audio_file_table(conn):
             num_channels INTEGER,
             bit_depth INTEGER ,
             encoding STRING,
+            file_size BIGINT,
+            mtime DOUBLE,
+            deleted BOOLEAN DEFAULT FALSE,
             FOREIGN KEY (dataset_id) REFERENCES dataset(id),
             UNIQUE (path, dataset_id)
         )
         """
     )
 
+def migrate_audio_file_table(conn):
+    # databases made before we tracked file stats (see vampnet.db.sync)
+    # don't have these columns yet
+    conn.sql("ALTER TABLE audio_file ADD COLUMN IF NOT EXISTS file_size BIGINT")
+    conn.sql("ALTER TABLE audio_file ADD COLUMN IF NOT EXISTS mtime DOUBLE")
+    conn.sql("ALTER TABLE audio_file ADD COLUMN IF NOT EXISTS deleted BOOLEAN DEFAULT FALSE")
+
 def _denull(d):
     # replace none with "null" string
     for k, _v in d.__dict__.items():
@@ -128,6 +140,27 @@ def insert_audio_file(conn, audio_file: AudioFile):
     df = pd.DataFrame([audio_file.__dict__])
     conn.insert("audio_file", df)
 
+def insert_audio_files(conn, audio_files: List[AudioFile]) -> int:
+    """
+    inserts many audio files in a single statement,
+    which is much faster than calling insert_audio_file in a loop.
+    returns the number of rows inserted.
+    """
+    if len(audio_files) == 0:
+        return 0
+    df = pd.DataFrame([af.__dict__ for af in audio_files])
+    conn.register("_audio_files_df", df)
+    try:
+        conn.execute("""
+            INSERT INTO audio_file BY NAME
+            SELECT path, dataset_id, num_frames, sample_rate, num_channels, bit_depth, encoding,
+                file_size, mtime
+            FROM _audio_files_df
+        """)
+    finally:
+        conn.unregister("_audio_files_df")
+    return len(df)
+
 
 def get_audio_file_table(conn, dataset_id: int) -> pd.DataFrame:
     return conn.execute(f"""
@@ -195,6 +228,28 @@ def insert_ctrl_sig(conn, ctrl_sig: ControlSignal):
         ctrl_sig.hop_size, ctrl_sig.num_frames, ctrl_sig.num_channels)
     ).fetchone()[0]
 
+# a table for control signals we couldn't extract, 
+# so that preprocess doesn't retry (and trip over) the same bad files forever
+def create_ctrl_sig_failure_table(conn):
+    # IF NOT EXISTS, so this also migrates databases made before we had it
+    conn.sql(
+        """
+        CREATE TABLE IF NOT EXISTS ctrl_sig_failure (
+            audio_file_id INTEGER NOT NULL,
+            name STRING NOT NULL,
+            error STRING,
+            FOREIGN KEY (audio_file_id) REFERENCES audio_file(id),
+            UNIQUE (audio_file_id, name)
+        )
+        """
+    )
+
+def insert_ctrl_sig_failure(conn, audio_file_id: int, name: str, error: str):
+    conn.execute(
+        "INSERT INTO ctrl_sig_failure (audio_file_id, name, error) VALUES (?, ?, ?)",
+        (audio_file_id, name, error)
+    )
+
 # a table for train/test splits
 @dataclass
 class Split:
@@ -233,12 +288,13 @@ def insert_split(conn, split: Split):
 def init():
     from vampnet.db import (
         create_dataset_table, create_audio_file_table,
-        create_ctrl_sig_table, create_split_table
+        create_ctrl_sig_table, create_ctrl_sig_failure_table, create_split_table
     )
     for fn in [
         create_dataset_table,
         create_audio_file_table,
         create_ctrl_sig_table,
+        create_ctrl_sig_failure_table,
         create_split_table
     ]:
         conn = vampnet.db.conn(read_only=False)
@@ -1,3 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
 from pathlib import Path
 import audiotools as at
 
@@ -9,9 +12,47 @@ import pandas as pd
 
 import vampnet
 
+AUDIO_EXT = [".wav", ".mp3", ".flac", ".WAV", ".MP3", ".FLAC"]
+
+def probe_file(file, audio_folder: str, dataset_id: int):
+    """reads the metadata of an audio file, returns an AudioFile or None if we can't read it"""
+    try: 
+        info = torchaudio.info(file, backend="ffmpeg")
+        stat = os.stat(file)
+        return vampnet.db.AudioFile(
+            path=str(Path(file).absolute().relative_to(Path(audio_folder).absolute())),
+            dataset_id=dataset_id,
+            num_frames=info.num_frames,
+            sample_rate=info.sample_rate,
+            num_channels=info.num_channels,
+            bit_depth=info.bits_per_sample,
+            encoding=info.encoding,
+            file_size=stat.st_size,
+            mtime=stat.st_mtime,
+        )
+    except Exception as e:
+        print(f"Could not process {file}: {e}")
+        return None
+
+
+def probe_files(audio_files, audio_folder: str, dataset_id: int, num_workers: int = 16):
+    """
+    probes many audio files concurrently, with up to num_workers threads.
+    (probing is mostly waiting on disk and ffmpeg, so threads are enough)
+    returns a list with an AudioFile (or None, if it failed) for each file.
+    """
+    probe = functools.partial(probe_file, audio_folder=audio_folder, dataset_id=dataset_id)
+    if num_workers <= 1:
+        return list(tqdm.tqdm(map(probe, audio_files), total=len(audio_files)))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(tqdm.tqdm(executor.map(probe, audio_files), total=len(audio_files)))
+
+
 def create_dataset(
     audio_folder: str = None,
-    dataset_name: str = None
+    dataset_name: str = None,
+    num_workers: int = 16,
 ):
     """creates a new duckdb dataset, and populates it with audio files from a folder.
     """
@@ -29,48 +70,16 @@ def create_dataset(
 
     # create a new table for our audio files
     print(f"looking for audio files in {audio_folder}")
-    audio_files = at.util.find_audio(
-        Path(audio_folder), ext=[".wav", ".mp3", ".flac", ".WAV", ".MP3", ".FLAC"]
-    )
+    audio_files = at.util.find_audio(Path(audio_folder), ext=AUDIO_EXT)
     print(f"Found {len(audio_files)} audio files")
 
-    # for file in tqdm.tqdm(audio_files):
-
-    num_failed = 0
-    def process_file(file):
-        try: 
-            info = torchaudio.info(file, backend="ffmpeg")
-            af = vampnet.db.AudioFile(
-                path=str(Path(file).absolute().relative_to(Path(audio_folder).absolute())),
-                dataset_id=dataset_id,
-                num_frames=info.num_frames,
-                sample_rate=info.sample_rate,
-                num_channels=info.num_channels,
-                bit_depth=info.bits_per_sample,
-                encoding=info.encoding
-            )
-            
-        except Exception as e:
-            global num_failed
-            print(f"Could not process {file}: {e}")
-            num_failed += 1
-        
-        return af
-
-
-    # from vampnet.util import parallelize
-    # afs = parallelize(process_file, audio_files, parallel="thread_map")
-    from concurrent.futures import ThreadPoolExecutor
-    import tqdm
-    # with ThreadPoolExecutor() as executor:
-    afs = list(tqdm.tqdm(map(process_file, audio_files), total=len(audio_files)))
-
-    # now, we can write to the db 
-    for af in afs:
-        if af is not None:
-            vampnet.db.insert_audio_file(conn, af)
-
-        
+    afs = probe_files(audio_files, audio_folder, dataset_id, num_workers=num_workers)
+    num_failed = sum(af is None for af in afs)
+
+    # now, we can write to the db, all at once
+    vampnet.db.migrate_audio_file_table(conn)
+    vampnet.db.insert_audio_files(conn, [af for af in afs if af is not None])
+
     # ask if we should commit
     print(f"Processed {len(audio_files)} audio files")
     print(f"of which {num_failed} failed")
@@ -84,12 +93,14 @@ if __name__ == "__main__":
 
     parser.add_argument("--audio_folder", type=str, default=None, help="folder containing audio files")
     parser.add_argument("--dataset_name", type=str, default=None, help="name of the dataset")
+    parser.add_argument("--num_workers", type=int, default=16, help="number of threads probing audio files")
 
     args = parser.parse_args()
 
     create_dataset(
         audio_folder=args.audio_folder,
-        dataset_name=args.dataset_name
+        dataset_name=args.dataset_name,
+        num_workers=args.num_workers
     )
     
 
@@ -1,8 +1,8 @@
 
 from pathlib import Path
 from typing import Optional, List
+import numpy as np
 import torch
-import pandas as pd
 
 import vampnet
 from vampnet import mask as pmask
@@ -17,67 +17,106 @@ def pad_if_needed(codes, seq_len):
         pad_mask[-pad_len:] = 0
     return codes, pad_mask
 
+
+class AliasTable:
+    """
+    Walker's alias method for drawing from a discrete distribution.
+    O(n) to build, O(1) per draw, no matter how many outcomes there are.
+    """
+
+    def __init__(self, weights: np.ndarray):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        assert n > 0 and weights.sum() > 0, "need at least one positive weight"
+
+        prob = weights * n / weights.sum()
+        alias = np.arange(n, dtype=np.int64)
+        small = list(np.flatnonzero(prob < 1.0))
+        large = list(np.flatnonzero(prob >= 1.0))
+        # pair each underfull bucket with an overfull one
+        while small and large:
+            s, l = small.pop(), large.pop()
+            alias[s] = l
+            prob[l] -= 1.0 - prob[s]
+            (small if prob[l] < 1.0 else large).append(l)
+        # whatever's left is full, up to rounding error
+        prob[small + large] = 1.0
+
+        self.prob = prob
+        self.alias = alias
+
+    def __len__(self):
+        return len(self.prob)
+
+    def draw(self, rng: np.random.Generator) -> int:
+        i = int(rng.integers(0, len(self.prob)))
+        return i if rng.random() < self.prob[i] else int(self.alias[i])
+
+
 class VampNetDataset(torch.utils.data.Dataset):
     def __init__(self, dataset: str = vampnet.DATASET, 
         codes_key: str = vampnet.CODES_KEY,
         ctrl_keys: List[str] = vampnet.CTRL_KEYS, 
         seq_len: int = vampnet.SEQ_LEN, 
         split: Optional[str] = None, 
-        max_len: Optional[int] = None
+        max_len: Optional[int] = None,
+        backend: str = vampnet.DATASET_BACKEND,
+        seed: int = vampnet.SEED,
+        sampling: str = "weighted",
+        compact: bool = vampnet.COMPACT_BATCHES,
+        packing: bool = vampnet.SEQUENCE_PACKING,
     ):
-        conn = vampnet.db.conn(read_only=True)
-        # get the dataset id
-        # breakpoint()
+        # read the files we need from a manifest snapshot of the db,
+        # (see vampnet.db.manifest), so we (and our workers) never touch duckdb.
         print(f"Loading dataset {dataset}")
-        dataset_id, root = conn.execute(f"""
-            SELECT id, root 
-            FROM dataset 
-            WHERE name = '{dataset}'
-        """).fetchone()
-        self.root = Path(root)
-
-        # TODO : is there a way to do this in one query?
-        if split is None:
-            df = conn.execute(
-                f"""
-                SELECT cs.id, cs.path, cs.audio_file_id, cs.name, cs.hop_size, cs.num_frames
-                FROM ctrl_sig as cs
-                JOIN audio_file as af ON af.id = cs.audio_file_id
-                WHERE af.dataset_id = {dataset_id}
-                """, 
-            ).df()
-        else:
-            df = conn.execute(
-                f"""
-                SELECT cs.id, cs.path, cs.audio_file_id, cs.name, cs.hop_size, cs.num_frames, s.split 
-                FROM ctrl_sig as cs
-                JOIN audio_file as af ON af.id = cs.audio_file_id
-                JOIN split as s ON s.audio_file_id = af.id
-                WHERE af.dataset_id = {dataset_id} and s.split = '{split}'
-                """, 
-            ).df()
-            print(f"Loaded {len(df)} rows from the database for split {split}")
+        from vampnet.db.manifest import Manifest
+        self.manifest = Manifest.load_or_build(dataset, split, [codes_key] + ctrl_keys)
+        self.root = self.manifest.root
         self.split = split
+        print(f"Loaded {len(self.manifest)} files from the manifest for split {split}")
 
         #  shuffle, then take the first max_len
+        # (seeded, so every worker and every resumed run sees the same files)
+        rows = np.random.default_rng(seed % 2**32).permutation(len(self.manifest))
         if max_len is not None:
-            df = df.sample(frac=1).iloc[:max_len]
-        else:
-            df = df.sample(frac=1)
-        print(f"Using {len(df)} rows for split {split}")
-
-        # make a df for the codes key and for each ctrl key
-        # and we wanna use audio_file_id as the index for all
-        # of these dataframes
-        self.dfs = {}
-        for key in [codes_key] + ctrl_keys:
-            self.dfs[key] = df[df["name"] == key].set_index("audio_file_id")
-
-        # make pd dataframe with just the audio_file_id column that we'll scramble and sample from
-        self.index_df = pd.DataFrame({"audio_file_id": df["audio_file_id"].unique()})
-        self.index_df_samples = self.index_df.copy().sample(frac=1)
-        
+            rows = rows[:max_len]
+        print(f"Using {len(rows)} files for split {split}")
+
+        # the sampling index: one entry per file, pointing at a row of the manifest.
+        # these are plain numpy arrays, so they're shared by forked workers for free.
+        self.rows = rows
+        self.audio_file_ids = self.manifest.audio_file_ids[rows]
+        self.num_frames = self.manifest.num_frames[rows]
+
+        # how do we pick windows?
+        # "weighted": draw files in proportion to their length (so a 20 min stem
+        #   comes up 600x more often than a 2s clip), then a random offset in the file.
+        # "per_file": one window per file, at a random (but fixed) offset. 
+        #   deterministic, and as many items as files, so it's what we validate on.
+        # "exhaustive": every non-overlapping window of every file, once, in order.
+        #   deterministic too, but a long file has many windows, so it can be much bigger.
+        self.sampling = sampling
+        if sampling == "weighted":
+            self.alias_table = AliasTable(self.num_frames) if len(self.num_frames) else None
+        elif sampling == "exhaustive":
+            # cumulative window count, so we can map a window back to its file
+            num_windows = -(-self.num_frames // seq_len)
+            self.cum_windows = np.cumsum(num_windows)
+        elif sampling != "per_file":
+            raise ValueError(f"sampling must be one of 'weighted', 'per_file', 'exhaustive', but got {sampling}")
+
+        # if compact, tokens stay int16 (instead of int64) all the way through the dataloader,
+        # which makes batches 4x smaller to pass from workers. widen them on the device.
+        self.compact = compact
+        # if packing, windows shorter than seq_len are filled up with more files
+        # instead of padding, and each item gets a segment_ids tensor
+        # so the model can keep attention within each file. see VampNet.forward
+        self.packing = packing and sampling == "weighted"
+
+        self.seed = seed
+        self.epoch = 0
         self.seq_len = seq_len
+        self.codes_key = codes_key
         self.ctrl_keys = ctrl_keys
         self.dataset_name = dataset
 
@@ -86,74 +125,168 @@ class VampNetDataset(torch.utils.data.Dataset):
             c.name: c for c in load_control_signal_extractors()
         }
 
-    def __len__(self):
-        # we can find roughly the length by counting all of the frames for our codes key
-        # and dividing by the seq len
-        # HACK: if val, then just count ids, not frames
-        if self.split == "val":
-            return len(self.index_df_samples)
-        else:
-            n_frames = self.dfs[vampnet.CODES_KEY]["num_frames"].sum()
-            return n_frames // self.seq_len
-    
-    def __getitem__(self, idx):
-        # take a sample out of the index df, remove it from the df
-        # if it's empty, reset the index df and reshuffle
-        audio_file_id = self.index_df_samples.iloc[0]["audio_file_id"]
-        self.index_df_samples = self.index_df_samples.iloc[1:]
-        if len(self.index_df_samples) == 0:
-            self.index_df_samples = self.index_df.copy().sample(frac=1)
-        
-        # load our codes key, sample an offset and return the slice
-        code_data = self.dfs[vampnet.CODES_KEY].loc[audio_file_id]
-        # get the total number of frames
-        n_frames = code_data["num_frames"]
-        # sample a random offset
-        if n_frames > self.seq_len:
-            offset = torch.randint(0, n_frames - self.seq_len, (1,)).item()
+        # where do we read our control signals from? 
+        # "files": one cache folder per control signal
+        # "shards": packed shard files, see vampnet.db.shard
+        self.backend = backend
+        if backend == "shards":
+            from vampnet.db.shard import ShardStore
+            self.shards = {
+                key: ShardStore(dataset, key) for key in [codes_key] + ctrl_keys
+            }
+        elif backend == "files":
+            self.shards = None
         else:
-            offset = 0
-        
+            raise ValueError(f"backend must be one of 'files', 'shards', but got {backend}")
+
+    def _load_ctrl(self, key: str, file_idx: int, offset: int, num_frames: int):
+        if self.shards is not None:
+            return self.Controls[key](
+                ctrl=self.shards[key].load(
+                    self.audio_file_ids[file_idx], offset=offset, num_frames=num_frames
+                )
+            )
+        path = self.manifest.path(key, self.rows[file_idx])
+        return self.Controls[key].load(
+            vampnet.CACHE_PATH / self.dataset_name / path, offset=offset, num_frames=num_frames
+        )
+
+    def _load_window(self, file_idx: int, offset: int, num_frames: int, rng: np.random.Generator):
+        """
+        loads up to num_frames frames of a file, starting at offset, from a random channel.
+        returns (codes, ctrl), unpadded. ctrl is None if we have no control signals.
+        """
         # load from the path
-        from vampnet.controls.codec import DACControl
-        codes = DACControl.load(vampnet.CACHE_PATH / self.dataset_name / code_data["path"], offset=offset, num_frames=self.seq_len)
+        codes = self._load_ctrl(self.codes_key, file_idx, offset, num_frames)
 
         # load the control signals
         ctrls = {}
         for key in self.ctrl_keys:
-            ctrls[key] = self.Controls[key].load(
-                vampnet.CACHE_PATH / self.dataset_name / self.dfs[key].loc[audio_file_id]["path"], offset=offset, num_frames=self.seq_len
-            )
+            ctrls[key] = self._load_ctrl(key, file_idx, offset, num_frames)
 
         # pick a channel 
-        channel = torch.randint(0, codes.ctrl.shape[0], (1,)).item()
-        codes.ctrl, cmask = pad_if_needed(codes.ctrl, self.seq_len)
-        codes.ctrl = codes.ctrl[channel, :, :]
+        channel = int(rng.integers(0, codes.ctrl.shape[0]))
+        codes = codes.ctrl[channel, :, :]
 
         if len(ctrls) != 0:
             # concat all control tensors
             ctrl = torch.cat([
                 ctrls[key].ctrl for key in self.ctrl_keys
             ], dim=1)
-
-            # make a ctx mask
-            ctrl, cmask = pad_if_needed(ctrl, self.seq_len)
             ctrl = ctrl[:, channel, :]
         else:
             ctrl = None
+        return codes, ctrl
+
+    def _pack(self, codes: torch.Tensor, ctrl: Optional[torch.Tensor], rng: np.random.Generator):
+        """
+        fills up a short window with (windows of) more files.
+        returns the packed codes and ctrl, and the segment id of every frame (starting at 1)
+        """
+        segments = [(codes, ctrl)]
+        filled = codes.shape[-1]
+        # don't bother with tiny segments, they're mostly context-free
+        min_segment = max(1, self.seq_len // 16)
+        while self.seq_len - filled >= min_segment:
+            file_idx = self.alias_table.draw(rng)
+            n_frames = int(self.num_frames[file_idx])
+            remaining = self.seq_len - filled
+            offset = int(rng.integers(0, n_frames - remaining)) if n_frames > remaining else 0
+            codes, ctrl = self._load_window(file_idx, offset, remaining, rng)
+            segments.append((codes, ctrl))
+            filled += codes.shape[-1]
+
+        segment_ids = torch.cat([
+            torch.full((c.shape[-1],), i + 1, dtype=torch.long) for i, (c, _) in enumerate(segments)
+        ])
+        codes = torch.cat([c for c, _ in segments], dim=-1)
+        ctrl = torch.cat([c for _, c in segments], dim=-1) if ctrl is not None else None
+        return codes, ctrl, segment_ids
+
+    def __len__(self):
+        if self.sampling == "exhaustive":
+            return int(self.cum_windows[-1]) if len(self.cum_windows) else 0
+        if self.sampling == "per_file":
+            return len(self.rows)
+        # we can find roughly the length by counting all of the frames for our codes key
+        # and dividing by the seq len
+        return int(self.num_frames.sum()) // self.seq_len
+
+    def set_epoch(self, epoch: int):
+        """
+        reseeds the sampler, so that each epoch draws different windows.
+        call this before iterating over a new epoch.
+        """
+        self.epoch = epoch
+
+    def locate(self, idx: int):
+        """
+        deterministically maps an index to (file index, offset, channel rng).
+        the same (seed, epoch, idx) always gives the same window, 
+        no matter which worker asks for it, so sampling is resumable from any idx.
+        """
+        if self.sampling == "exhaustive":
+            # window idx is the j-th window of its file.
+            # the last one may run off the end of the file, and gets padded
+            rng = np.random.default_rng([self.seed % 2**32, idx])
+            file_idx = int(np.searchsorted(self.cum_windows, idx, side="right"))
+            first_window = int(self.cum_windows[file_idx - 1]) if file_idx > 0 else 0
+            return file_idx, (idx - first_window) * self.seq_len, rng
+
+        if self.sampling == "per_file":
+            # the same window of file idx every epoch
+            rng = np.random.default_rng([self.seed % 2**32, idx])
+            file_idx = idx
+        else:
+            rng = np.random.default_rng([self.seed % 2**32, self.epoch, idx])
+
+            # pick a file in proportion to its length
+            file_idx = self.alias_table.draw(rng)
 
+        # sample a random offset
+        n_frames = int(self.num_frames[file_idx])
+        if n_frames > self.seq_len:
+            offset = int(rng.integers(0, n_frames - self.seq_len))
+        else:
+            offset = 0
+        return file_idx, offset, rng
+    
+    def __getitem__(self, idx):
+        file_idx, offset, rng = self.locate(idx)
+        codes, ctrl = self._load_window(file_idx, offset, self.seq_len, rng)
+
+        item = {}
+        if self.packing and codes.shape[-1] < self.seq_len:
+            codes, ctrl, segment_ids = self._pack(codes, ctrl, rng)
+        else:
+            segment_ids = torch.ones(codes.shape[-1], dtype=torch.long)
+
+        # pad whatever's left. padding is segment 0
+        codes, cmask = pad_if_needed(codes, self.seq_len)
+        if ctrl is not None:
+            ctrl, cmask = pad_if_needed(ctrl, self.seq_len)
+        if self.packing:
+            segment_ids, _ = pad_if_needed(segment_ids, self.seq_len)
+            item["segment_ids"] = segment_ids.short() if self.compact else segment_ids
+
+        if self.compact:
+            return dict(
+                codes=codes.short(),
+                ctrls=ctrl,
+                ctx_mask=cmask.short(),
+                **item,
+            )
         return dict(
-            codes=codes.ctrl.long(),
+            codes=codes.long(),
             ctrls=ctrl,
             ctx_mask=cmask.long(),
+            **item,
         )
     
     @property
     def control_dim(self):
-        # get a random item
+        # get an item (sampling is stateless, so this doesn't disturb anything)
         item = self[0]
-        # repopulate the index df
-        self.index_df_samples = self.index_df.copy().sample(frac=1)
         return item["ctrls"].shape[-1]
 
     @staticmethod   
@@ -162,7 +295,9 @@ class VampNetDataset(torch.utils.data.Dataset):
         for key in batch[0].keys():
             val = batch[0][key]
             if isinstance(val, torch.Tensor):
-                out[key] = torch.stack([item[key] for item in batch])
+                # inside a worker, this stacks straight into shared memory,
+                # so the batch isn't copied again on its way to the main process
+                out[key] = torch.utils.data.default_collate([item[key] for item in batch])
             elif isinstance(val, dict):
                 out[key] = VampNetDataset.collate([item[key] for item in batch])
             else:
@@ -172,7 +307,11 @@ class VampNetDataset(torch.utils.data.Dataset):
 
 def build_datasets(dataset=vampnet.DATASET, split=True):
     if split:
-        return VampNetDataset(dataset=dataset, split="train"), VampNetDataset(dataset=dataset, split="val", max_len=10000), VampNetDataset(dataset=dataset, split="test", max_len=10000)
+        return (
+            VampNetDataset(dataset=dataset, split="train"), 
+            VampNetDataset(dataset=dataset, split="val", max_len=10000, sampling=vampnet.VAL_SAMPLING), 
+            VampNetDataset(dataset=dataset, split="test", max_len=10000, sampling="exhaustive"),
+        )
     else:
         print(f"fine-tuning, will validate on the training data!!!")
         return VampNetDataset(dataset=dataset, ), VampNetDataset(dataset=dataset,), VampNetDataset(dataset=dataset, )
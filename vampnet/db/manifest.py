@@ -0,0 +1,207 @@
+"""
+a snapshot of the rows VampNetDataset needs from the database, as flat numpy files.
+
+the dataset (and every dataloader worker) memory maps the manifest
+instead of querying duckdb and building dataframes, so it starts instantly
+and workers share the pages instead of each holding their own copy.
+
+a manifest has one row per audio file that has all of the requested control signals:
+    audio_file_id.npy               int64, sorted
+    num_frames.npy                  int64, number of frames of the first control signal
+    <name>.paths.bin                utf-8 bytes of all the paths of control signal <name>
+    <name>.path_offsets.npy         int64, where each row's path starts (and ends) in the .bin
+    manifest.json                   dataset, root, split and names
+
+python -m vampnet.db.manifest --dataset example --split train
+"""
+import fcntl
+import json
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+import vampnet
+
+
+def manifest_dir(dataset: str, split: Optional[str] = None) -> Path:
+    return Path(vampnet.CACHE_PATH) / dataset / "manifests" / (split or "all")
+
+
+@contextmanager
+def _build_lock(dataset: str, split: Optional[str] = None):
+    # one builder at a time (e.g. when every ddp rank starts up at once)
+    lock_path = manifest_dir(dataset, split).with_suffix(".lock")
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def clear_manifests(dataset: str):
+    """removes all manifests of a dataset, e.g. after the db changes"""
+    shutil.rmtree(Path(vampnet.CACHE_PATH) / dataset / "manifests", ignore_errors=True)
+
+
+def build_manifest(
+    dataset: str = vampnet.DATASET,
+    split: Optional[str] = None,
+    names: List[str] = None,
+) -> Path:
+    """
+    writes the manifest for a dataset (and split) in one query.
+    names are the control signals to include, the first one being the codes.
+    """
+    with _build_lock(dataset, split):
+        return _build_manifest(dataset, split, names)
+
+
+def _build_manifest(dataset: str, split: Optional[str], names: Optional[List[str]]) -> Path:
+    # NOTE: must hold _build_lock
+    names = names or [vampnet.CODES_KEY] + vampnet.CTRL_KEYS
+
+    conn = vampnet.db.conn(read_only=True)
+    dataset_id, root = vampnet.db.get_dataset(conn, dataset)
+
+    # one row per audio file, with a path column per control signal.
+    # files missing any of the control signals are left out.
+    select = ", ".join(f"cs{i}.path as path{i}" for i in range(len(names)))
+    joins = "\n".join(
+        f"JOIN ctrl_sig as cs{i} ON cs{i}.audio_file_id = af.id AND cs{i}.name = ?"
+        for i in range(len(names))
+    )
+    params = list(names) + [dataset_id]
+    where = "af.dataset_id = ?"
+    if split is not None:
+        joins += "\nJOIN split as s ON s.audio_file_id = af.id"
+        where += " AND s.split = ?"
+        params.append(split)
+
+    rows = conn.execute(f"""
+        SELECT af.id, cs0.num_frames, {select}
+        FROM audio_file as af
+        {joins}
+        WHERE {where}
+        ORDER BY af.id
+    """, params).fetchnumpy()
+
+    out_dir = manifest_dir(dataset, split)
+    # write to a temporary folder first, so readers never see half a manifest. 
+    # it's unique to us, so concurrent builders don't clobber each other's
+    out_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=out_dir.parent, prefix=f".{out_dir.name}.tmp-"))
+
+    np.save(tmp_dir / "audio_file_id.npy", np.asarray(rows["id"], dtype=np.int64))
+    np.save(tmp_dir / "num_frames.npy", np.asarray(rows["num_frames"], dtype=np.int64))
+    for i, name in enumerate(names):
+        paths = [p.encode("utf-8") for p in rows[f"path{i}"]]
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in paths], out=offsets[1:])
+        (tmp_dir / f"{name}.paths.bin").write_bytes(b"".join(paths))
+        np.save(tmp_dir / f"{name}.path_offsets.npy", offsets)
+
+    with open(tmp_dir / "manifest.json", "w") as f:
+        json.dump({
+            "dataset": dataset, "root": root, "split": split,
+            "names": list(names), "num_files": len(rows["id"]),
+        }, f)
+
+    # swap it in: move the old one out of the way first, since we can't rename over a folder
+    old_dir = Path(tempfile.mkdtemp(dir=out_dir.parent, prefix=f".{out_dir.name}.old-"))
+    try:
+        out_dir.rename(old_dir / "manifest")
+    except FileNotFoundError:
+        pass
+    try:
+        tmp_dir.rename(out_dir)
+    except OSError:
+        # someone else swapped theirs in just now (e.g. on another machine, where the lock 
+        # doesn't reach). it's from the same db, so keep it
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    print(f"wrote a manifest with {len(rows['id'])} files to {out_dir}")
+    return out_dir
+
+
+class Manifest:
+    """
+    reads a manifest made by `build_manifest`.
+    everything is memory mapped lazily, so it's safe to pickle this into dataloader workers.
+    """
+
+    def __init__(self, dataset: str, split: Optional[str] = None):
+        self.dir = manifest_dir(dataset, split)
+        with open(self.dir / "manifest.json") as f:
+            self.meta = json.load(f)
+        self._arrays = {}
+
+    @classmethod
+    def load_or_build(cls, dataset: str, split: Optional[str] = None, names: List[str] = None):
+        names = names or [vampnet.CODES_KEY] + vampnet.CTRL_KEYS
+        path = manifest_dir(dataset, split) / "manifest.json"
+
+        def usable():
+            if not path.exists():
+                return False
+            with open(path) as f:
+                return all(n in json.load(f)["names"] for n in names)
+
+        if not usable():
+            with _build_lock(dataset, split):
+                # whoever held the lock before us may have just built it
+                if not usable():
+                    _build_manifest(dataset, split, names)
+        return cls(dataset, split)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+    def __len__(self):
+        return self.meta["num_files"]
+
+    @property
+    def root(self) -> Path:
+        return Path(self.meta["root"])
+
+    def _array(self, filename: str) -> np.ndarray:
+        if filename not in self._arrays:
+            if filename.endswith(".bin"):
+                arr = np.memmap(self.dir / filename, dtype=np.uint8, mode="r") \
+                    if (self.dir / filename).stat().st_size > 0 else np.zeros(0, dtype=np.uint8)
+            else:
+                arr = np.load(self.dir / filename, mmap_mode="r")
+            self._arrays[filename] = arr
+        return self._arrays[filename]
+
+    @property
+    def audio_file_ids(self) -> np.ndarray:
+        return self._array("audio_file_id.npy")
+
+    @property
+    def num_frames(self) -> np.ndarray:
+        return self._array("num_frames.npy")
+
+    def path(self, name: str, row: int) -> str:
+        """the path of control signal `name` for a row"""
+        offsets = self._array(f"{name}.path_offsets.npy")
+        start, end = int(offsets[row]), int(offsets[row + 1])
+        return bytes(self._array(f"{name}.paths.bin")[start:end]).decode("utf-8")
+
+
+if __name__ == "__main__":
+    import yapecs
+    parser = yapecs.ArgumentParser()
+
+    parser.add_argument("--dataset", type=str, default=vampnet.DATASET, help="dataset to snapshot")
+    parser.add_argument("--split", type=str, default=None, help="split to snapshot. all files if not given")
+
+    args = parser.parse_args()
+    build_manifest(**vars(args))
@@ -3,76 +3,89 @@ train-val-test split on a dataset
 specifically, we want to create splits along 
 audio_file_id
 """
+import hashlib
 from pathlib import Path
 import audiotools as at
 
 import argbind
 import tqdm
 import duckdb
+import numpy as np
 import pandas as pd
 
 import vampnet
 
+def split_buckets(paths, seed: int = vampnet.SEED) -> np.ndarray:
+    """
+    maps each path to a number in [0, 1) by hashing it (with a seed).
+    the same path always lands in the same bucket, no matter what else is in the dataset,
+    so files added later never move existing files across splits.
+    """
+    buckets = np.empty(len(paths), dtype=np.float64)
+    for i, path in enumerate(paths):
+        digest = hashlib.sha1(f"{seed}:{path}".encode()).digest()
+        buckets[i] = int.from_bytes(digest[:8], "little") / 2**64
+    return buckets
+
+
 def partition_dataset(
     dataset: str = vampnet.DATASET,
     train: float = vampnet.TRAIN_PROPORTION,
     val: float = vampnet.VAL_PROPORTION,
-    test: float = vampnet.TEST_PROPORTION 
+    test: float = vampnet.TEST_PROPORTION,
+    seed: int = vampnet.SEED,
 ):
+    """
+    assigns a split to every audio file in a dataset that doesn't have one yet.
+    files are bucketed by a hash of their path, so the splits are deterministic, 
+    and re-running this after adding files only assigns the new ones.
+    """
     assert dataset is not None
     # make sure our proportions sum to 1
     assert train + val + test == 1.0
 
     # connect to our datasets table
     conn = vampnet.db.conn(read_only=False)
-    # begin a transaction
-    conn.sql("BEGIN TRANSACTION")
 
     # get the dataset id and root
     dataset_id, root = vampnet.db.get_dataset(conn, dataset)
     print(f"Found dataset {dataset} at {root}")
 
-    # get the audio files and their ids
-    audio_file_ids = conn.execute(f"""
-        SELECT id 
-        FROM audio_file
-        WHERE dataset_id = {dataset_id}
-    """).fetchall()
-    print(f"Found {len(audio_file_ids)} audio files")
-
-    # shuffle the audio files
-    import random
-    random.shuffle(audio_file_ids)
-
-    # calculate the number of audio files in each split
-    n_train = int(train * len(audio_file_ids))
-    n_val = int(val * len(audio_file_ids))
-    n_test = len(audio_file_ids) - n_train - n_val
-
-    # insert the splits into the partition table
-    for i, audio_file_id in enumerate(audio_file_ids):
-        if i < n_train:
-            split = 'train'
-        elif i < n_train + n_val:
-            split = 'val'
-        else:
-            split = 'test'
-
-        split = vampnet.db.Split(
-            audio_file_id=audio_file_id[0],
-            split=split
-        )
-
-        vampnet.db.insert_split(conn, split)
-
-
-    conn.sql("COMMIT")
+    # get the audio files that don't have a split yet
+    df = conn.execute("""
+        SELECT af.id as audio_file_id, af.path
+        FROM audio_file as af
+        LEFT JOIN split as s ON s.audio_file_id = af.id
+        WHERE af.dataset_id = ? AND s.id IS NULL
+    """, (dataset_id,)).df()
+    print(f"Found {len(df)} audio files without a split")
+    if len(df) == 0:
+        return
+
+    buckets = split_buckets(df["path"].tolist(), seed)
+    df["split"] = np.where(
+        buckets < train, "train", np.where(buckets < train + val, "val", "test")
+    )
+    print(df["split"].value_counts().to_string())
+
+    # insert the splits into the partition table, all at once
+    conn.register("_split_df", df[["audio_file_id", "split"]])
+    conn.execute("""
+        INSERT INTO split (audio_file_id, split)
+        SELECT audio_file_id, split FROM _split_df
+    """)
+    conn.unregister("_split_df")
+    # the splits changed, so any manifests are stale
+    vampnet.db.manifest.clear_manifests(dataset)
     print("done! :)")
 
 
 if __name__ == "__main__":
-    # args = argbind.parse_args()
-    # partition_dataset = argbind.bind(without_prefix=True)(partition_dataset)
+    import yapecs
+    parser = yapecs.ArgumentParser()
+
+    parser.add_argument("--dataset", type=str, default=vampnet.DATASET, help="dataset to partition")
+    parser.add_argument("--seed", type=int, default=vampnet.SEED, help="salt for the path hash")
 
-    # with argbind.scope(args):
-    partition_dataset()
\ No newline at end of file
+    args = parser.parse_args()
+    partition_dataset(**vars(args))
@@ -1,4 +1,7 @@
 from pathlib import Path
+import multiprocessing as mp
+import os
+import time
 import audiotools as at
 
 import argbind
@@ -10,76 +13,207 @@ import vampnet
 
 RAISE = True
 
+
+def _init_worker(num_threads: int):
+    # don't let every worker grab every core
+    import torch
+    torch.set_num_threads(num_threads)
+
+
+def encode_files(job):
+    """
+    encodes a group of audio files with a control signal extractor
+    and saves them to the cache. runs inside a worker process,
+    so it never touches the database. the group is encoded in one go 
+    (see Control.from_signals), so the codec sees big batches even for short files.
+
+    returns a list of (audio_id, path, ctrl_sig row or None, duration in seconds, error or None)
+    """
+    Ctrl, root, dataset, files = job
+
+    # load everything we can
+    results, sigs, loaded = [], [], []
+    for audio_id, path in files:
+        try:
+            sigs.append(at.AudioSignal(Path(root) / path))
+            loaded.append((audio_id, path))
+        except Exception as e:
+            results.append((audio_id, path, None, 0.0, f"{type(e).__name__}: {e}"))
+
+    try:
+        ctrlsigs = Ctrl.from_signals(sigs)
+    except Exception:
+        # something in the group is bad, find out what
+        ctrlsigs = []
+        for sig in sigs:
+            try:
+                ctrlsigs.append(Ctrl.from_signal(sig))
+            except Exception as e:
+                ctrlsigs.append(e)
+
+    for (audio_id, path), sig, ctrlsig in zip(loaded, sigs, ctrlsigs):
+        try:
+            if isinstance(ctrlsig, Exception):
+                raise ctrlsig
+
+            out_path = Path(vampnet.CACHE_PATH) / dataset / Path(path).with_suffix(Ctrl.ext)
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            ctrlsig.save(out_path)
+
+            ctrlsig_file = vampnet.db.ControlSignal(
+                path=str(out_path.absolute().relative_to(Path(vampnet.CACHE_PATH / dataset).absolute())),
+                audio_file_id=audio_id,
+                name=Ctrl.name,
+                hop_size=ctrlsig.hop_size,
+                num_frames=ctrlsig.num_frames,
+                num_channels=ctrlsig.num_channels
+            )
+            results.append((audio_id, path, ctrlsig_file, sig.duration, None))
+        except Exception as e:
+            results.append((audio_id, path, None, 0.0, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def insert_batch(conn, rows, failures=()):
+    """
+    inserts a batch of control signals (and the files we failed on, 
+    as (audio_file_id, name, error)) in a single transaction
+    """
+    conn.sql("BEGIN TRANSACTION")
+    try:
+        for row in rows:
+            vampnet.db.insert_ctrl_sig(conn, row)
+        for failure in failures:
+            vampnet.db.insert_ctrl_sig_failure(conn, *failure)
+    except Exception:
+        conn.sql("ROLLBACK")
+        raise
+    conn.sql("COMMIT")
+
+
 def preprocess(
-    dataset: str = None
+    dataset: str = None,
+    num_workers: int = vampnet.NUM_WORKERS,
+    commit_every: int = 64,
+    files_per_job: int = 8,
+    retry_failed: bool = False,
 ):
     """
     encodes the audio files with the codec model
-    and populates them into the database. 
+    and populates them into the database.
+
+    files are encoded in parallel by a pool of worker processes (each with its own codec),
+    and the results are committed every `commit_every` files.
+    each worker encodes `files_per_job` files at a time, batching their codec windows together.
+    files that already have a control signal in the database are skipped,
+    so an interrupted run can just be restarted. 
+    files we failed on are recorded (in the ctrl_sig_failure table) and skipped too, 
+    so a corrupt file can't block the job. pass retry_failed to give them another go.
     """
     assert dataset is not None
 
     # connect to our datasets table
     conn = vampnet.db.conn(read_only=False)
-    # begin a transatcion
-    conn.sql("BEGIN TRANSACTION")
+    vampnet.db.migrate_audio_file_table(conn)
+    vampnet.db.create_ctrl_sig_failure_table(conn)
 
     # get the dataset id and root
-    dataset_id, root = conn.execute(f"""
-        SELECT id, root 
-        FROM dataset 
-        WHERE name = '{dataset}'
-    """).fetchone()
+    dataset_id, root = vampnet.db.get_dataset(conn, dataset)
     print(f"Found dataset {dataset} at {root}")
 
-    # get the audio files and their ids
-    audio_files = conn.execute(f"""
-        SELECT id, path 
-        FROM audio_file
-        WHERE dataset_id = {dataset_id}
-    """).fetchall()
-    print(f"Found {len(audio_files)} audio files")
-
     for Ctrl in vampnet.controls.load_control_signal_extractors():
         print(f"processing control signal {Ctrl.name}")
 
-        # encode the audio files
-        num_failed = 0
-        for audio_id, path in tqdm.tqdm(audio_files):
-            try: 
-                sig = at.AudioSignal(Path(root) / path)
-                ctrlsig = Ctrl.from_signal(sig)
-                
-                out_path = Path(vampnet.CACHE_PATH) / dataset / Path(path).with_suffix(Ctrl.ext)
-                out_path.parent.mkdir(parents=True, exist_ok=True)
-                ctrlsig.save(out_path)
-
-                # add to our ctrl sig table
-                ctrlsig_file = vampnet.db.ControlSignal(
-                    path=str(out_path.absolute().relative_to(Path(vampnet.CACHE_PATH / dataset).absolute())),
-                    audio_file_id=audio_id, 
-                    name=Ctrl.name,
-                    hop_size=ctrlsig.hop_size,
-                    num_frames=ctrlsig.num_frames,
-                    num_channels=ctrlsig.num_channels
-                )
-                try:
-                    vampnet.db.insert_ctrl_sig(conn, ctrlsig_file)
-                except:
-                    print(f"Could not insert {out_path} into control signal table")
+        if retry_failed:
+            conn.execute("""
+                DELETE FROM ctrl_sig_failure
+                WHERE name = ? AND audio_file_id IN (SELECT id FROM audio_file WHERE dataset_id = ?)
+            """, (Ctrl.name, dataset_id))
+
+        # get the audio files that don't have this control signal yet (and haven't failed before)
+        audio_files = conn.execute("""
+            SELECT af.id, af.path
+            FROM audio_file as af
+            LEFT JOIN ctrl_sig as cs ON cs.audio_file_id = af.id AND cs.name = ?
+            LEFT JOIN ctrl_sig_failure as f ON f.audio_file_id = af.id AND f.name = ?
+            WHERE af.dataset_id = ? AND cs.id IS NULL AND f.audio_file_id IS NULL AND NOT af.deleted
+            ORDER BY af.id
+        """, (Ctrl.name, Ctrl.name, dataset_id)).fetchall()
+        num_skipped = conn.execute("""
+            SELECT count(*) FROM ctrl_sig_failure as f
+            JOIN audio_file as af ON af.id = f.audio_file_id
+            WHERE f.name = ? AND af.dataset_id = ?
+        """, (Ctrl.name, dataset_id)).fetchone()[0]
+        print(f"Found {len(audio_files)} audio files left to process")
+        if num_skipped > 0:
+            print(f"skipping {num_skipped} audio files that failed before (use --retry_failed to retry them)")
+        if len(audio_files) == 0:
+            continue
+
+        jobs = [
+            (Ctrl, root, dataset, audio_files[i:i + files_per_job]) 
+            for i in range(0, len(audio_files), files_per_job)
+        ]
+        if num_workers > 0:
+            # spawn, so workers don't inherit our db connection (or a cuda context)
+            pool = mp.get_context("spawn").Pool(
+                num_workers,
+                initializer=_init_worker,
+                initargs=(max(1, os.cpu_count() // num_workers),)
+            )
+            results = pool.imap_unordered(encode_files, jobs)
+        else:
+            pool = None
+            results = map(encode_files, jobs)
+
+        num_done, num_failed = 0, 0
+        audio_seconds = 0.0
+        pending, pending_failures = [], []
+        t0 = time.perf_counter()
+        try:
+            pbar = tqdm.tqdm(total=len(audio_files))
+            for audio_id, path, ctrlsig_file, duration, error in (r for rs in results for r in rs):
+                pbar.update(1)
+                if error is not None:
                     num_failed += 1
-            except Exception as e:
-                if RAISE:
-                    raise e
-                print(f"Could not process {path}: {e}")
-                num_failed += 1
-
-    # ask if we should commit
-    print(f"Processed {len(audio_files)} audio files")
-    print(f"of which {num_failed} failed")
-    
-    print("committing changes to the db.")
-    conn.sql("COMMIT")
+                    # remember it, so a restart doesn't trip over it again
+                    pending_failures.append((audio_id, Ctrl.name, error))
+                    if RAISE:
+                        raise RuntimeError(
+                            f"Could not process {path}: {error}\n"
+                            f"it won't be retried on restart, unless you pass --retry_failed"
+                        )
+                    print(f"Could not process {path}: {error}")
+                else:
+                    pending.append(ctrlsig_file)
+                    num_done += 1
+                    audio_seconds += duration
+
+                if len(pending) + len(pending_failures) >= commit_every:
+                    insert_batch(conn, pending, pending_failures)
+                    pending, pending_failures = [], []
+
+                elapsed = time.perf_counter() - t0
+                pbar.set_postfix({
+                    "files/s": f"{num_done / elapsed:.2f}",
+                    "audio h/s": f"{audio_seconds / 3600 / elapsed:.3f}",
+                })
+        finally:
+            # keep whatever we finished, even if we're bailing out
+            if pending or pending_failures:
+                print(f"committing {len(pending)} pending control signals ({len(pending_failures)} failures) to the db.")
+                insert_batch(conn, pending, pending_failures)
+            if pool is not None:
+                pool.terminate()
+            # the control signals changed, so any manifests (and shards) are stale
+            vampnet.db.manifest.clear_manifests(dataset)
+            if num_done > 0:
+                vampnet.db.shard.mark_shards_stale(dataset)
+
+        elapsed = time.perf_counter() - t0
+        print(f"Processed {num_done} audio files in {elapsed:.1f}s")
+        print(f"of which {num_failed} failed")
+        print(f"throughput: {num_done / elapsed:.2f} files/s, {audio_seconds / 3600 / elapsed:.3f} audio hours/s")
 
 
 
@@ -88,6 +222,10 @@ if __name__ == "__main__":
     parser = yapecs.ArgumentParser()
 
     parser.add_argument("--dataset", type=str, default=None, help="dataset to preprocess")
+    parser.add_argument("--num_workers", type=int, default=vampnet.NUM_WORKERS, help="number of encoding processes. 0 encodes in this process")
+    parser.add_argument("--commit_every", type=int, default=64, help="commit to the db every this many files")
+    parser.add_argument("--files_per_job", type=int, default=8, help="number of files each worker encodes together")
+    parser.add_argument("--retry_failed", action="store_true", help="retry files that failed in a previous run")
 
     args = parser.parse_args()
-    preprocess(**vars(args))
\ No newline at end of file
+    preprocess(**vars(args))
@@ -0,0 +1,205 @@
+"""
+pack the control signals of a preprocessed dataset into a few large shard files.
+
+every control signal (e.g. every .dac folder) becomes a contiguous, time-major
+block inside a raw shard file, and a sidecar index records where each block lives.
+VampNetDataset(backend="shards") then slices its windows straight out of the
+(memory mapped) shards, without opening a file or reading metadata per sample.
+
+python -m vampnet.db.shard --dataset example
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+import tqdm
+
+import vampnet
+
+# one record per control signal
+INDEX_DTYPE = np.dtype([
+    ("audio_file_id", np.int64),
+    ("shard", np.int32),
+    ("offset", np.int64),        # in elements, from the start of the shard
+    ("num_frames", np.int64),
+    ("num_channels", np.int32),
+    ("num_features", np.int32),  # e.g. the number of codebooks
+])
+
+
+def shard_dir(dataset: str, name: str) -> Path:
+    return Path(vampnet.CACHE_PATH) / dataset / "shards" / name
+
+
+def mark_shards_stale(dataset: str):
+    """
+    marks every shard of a dataset as stale, e.g. after its control signals changed. 
+    ShardStore refuses to read stale shards until they're packed again.
+    """
+    for meta_path in (Path(vampnet.CACHE_PATH) / dataset / "shards").glob("*/shards.json"):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta["stale"] = True
+        tmp_path = meta_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        tmp_path.replace(meta_path)
+
+
+def stale_shards(dataset: str):
+    """the names of the control signals whose shards are stale"""
+    names = []
+    for meta_path in (Path(vampnet.CACHE_PATH) / dataset / "shards").glob("*/shards.json"):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("stale", False):
+            names.append(meta["name"])
+    return sorted(names)
+
+
+def pack_shards(
+    dataset: str = None,
+    name: str = vampnet.CODES_KEY,
+    shard_size_gb: float = 4.0,
+):
+    """
+    packs all control signals called `name` for a dataset into shard files.
+    """
+    assert dataset is not None
+    from vampnet.controls import load_control_signal_extractors
+    Ctrl = {c.name: c for c in load_control_signal_extractors()}[name]
+
+    conn = vampnet.db.conn(read_only=True)
+    dataset_id, root = vampnet.db.get_dataset(conn, dataset)
+    print(f"Found dataset {dataset} at {root}")
+
+    ctrl_sigs = conn.execute("""
+        SELECT cs.audio_file_id, cs.path
+        FROM ctrl_sig as cs
+        JOIN audio_file as af ON af.id = cs.audio_file_id
+        WHERE af.dataset_id = ? AND cs.name = ?
+        ORDER BY cs.audio_file_id
+    """, (dataset_id, name)).fetchall()
+    print(f"Found {len(ctrl_sigs)} control signals called {name}")
+
+    out_dir = shard_dir(dataset, name)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    max_shard_bytes = int(shard_size_gb * 2**30)
+
+    index = np.zeros(len(ctrl_sigs), dtype=INDEX_DTYPE)
+    shard_files = []
+    dtype = None
+    f = None
+    shard_bytes = 0
+    for i, (audio_file_id, path) in enumerate(tqdm.tqdm(ctrl_sigs)):
+        ctrl = Ctrl.load(Path(vampnet.CACHE_PATH) / dataset / path).ctrl
+        # back to time first, so windows are contiguous
+        arr = np.ascontiguousarray(ctrl.permute(2, 0, 1).numpy())
+        if dtype is None:
+            dtype = arr.dtype
+        assert arr.dtype == dtype, f"all control signals must have the same dtype, but got {arr.dtype} and {dtype}"
+
+        # start a new shard if this one is full
+        if f is None or shard_bytes + arr.nbytes > max_shard_bytes:
+            if f is not None:
+                f.close()
+            shard_files.append(f"{name}-{len(shard_files):05d}.bin")
+            f = open(out_dir / shard_files[-1], "wb")
+            shard_bytes = 0
+
+        index[i] = (
+            audio_file_id, len(shard_files) - 1, shard_bytes // arr.itemsize,
+            arr.shape[0], arr.shape[1], arr.shape[2]
+        )
+        f.write(arr.tobytes())
+        shard_bytes += arr.nbytes
+
+    if f is not None:
+        f.close()
+
+    np.save(out_dir / "index.npy", index)
+    with open(out_dir / "shards.json", "w") as mf:
+        json.dump({
+            "name": name,
+            "dtype": str(dtype) if dtype is not None else None,
+            "shards": shard_files
+        }, mf)
+    print(f"packed {len(index)} control signals into {len(shard_files)} shards at {out_dir}")
+
+
+class ShardStore:
+    """
+    reads windows of control signals out of the shards made by `pack_shards`.
+    shards are memory mapped lazily, so it's safe to pickle this into dataloader workers.
+    """
+
+    def __init__(self, dataset: str, name: str = vampnet.CODES_KEY):
+        self.dir = shard_dir(dataset, name)
+        with open(self.dir / "shards.json") as f:
+            meta = json.load(f)
+        if meta.get("stale", False):
+            raise RuntimeError(
+                f"the shards at {self.dir} are stale, since the dataset changed after they were packed. "
+                f"repack them with python -m vampnet.db.shard --dataset {dataset} --name {name}"
+            )
+        self.dtype = np.dtype(meta["dtype"])
+        self.shard_files = meta["shards"]
+
+        index = np.load(self.dir / "index.npy")
+        order = np.argsort(index["audio_file_id"], kind="stable")
+        self.index = index[order]
+        self._shards = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    def __contains__(self, audio_file_id: int):
+        i = np.searchsorted(self.index["audio_file_id"], audio_file_id)
+        return i < len(self.index) and self.index["audio_file_id"][i] == audio_file_id
+
+    def _shard(self, i: int) -> np.memmap:
+        if self._shards is None:
+            self._shards = [None] * len(self.shard_files)
+        if self._shards[i] is None:
+            self._shards[i] = np.memmap(self.dir / self.shard_files[i], dtype=self.dtype, mode="r")
+        return self._shards[i]
+
+    def record(self, audio_file_id: int):
+        i = np.searchsorted(self.index["audio_file_id"], audio_file_id)
+        assert i < len(self.index) and self.index["audio_file_id"][i] == audio_file_id, \
+            f"audio file {audio_file_id} is not in the shards at {self.dir}"
+        return self.index[i]
+
+    def load(self, audio_file_id: int, offset: int = 0, num_frames: int = None) -> torch.Tensor:
+        """
+        returns frames [offset, offset + num_frames) of a control signal.
+        shape (num_channels, num_features, frames), like Control.load.
+        """
+        rec = self.record(audio_file_id)
+        num_frames = num_frames or int(rec["num_frames"])
+        frame_size = int(rec["num_channels"]) * int(rec["num_features"])
+
+        # clip to the end of the signal
+        start = min(offset, int(rec["num_frames"]))
+        end = min(offset + num_frames, int(rec["num_frames"]))
+
+        shard = self._shard(int(rec["shard"]))
+        block = shard[int(rec["offset"]) + start * frame_size : int(rec["offset"]) + end * frame_size]
+        arr = np.array(block).reshape(end - start, rec["num_channels"], rec["num_features"])
+        # transpose back out
+        return torch.from_numpy(arr).permute(1, 2, 0).contiguous()
+
+
+if __name__ == "__main__":
+    import yapecs
+    parser = yapecs.ArgumentParser()
+
+    parser.add_argument("--dataset", type=str, default=None, help="dataset to pack")
+    parser.add_argument("--name", type=str, default=vampnet.CODES_KEY, help="control signal to pack")
+    parser.add_argument("--shard_size_gb", type=float, default=4.0, help="max size of a single shard, in GB")
+
+    args = parser.parse_args()
+    pack_shards(**vars(args))
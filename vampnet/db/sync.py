@@ -0,0 +1,151 @@
+"""
+incrementally syncs a dataset with its audio folder, 
+so a growing library doesn't need to be re-created from scratch.
+
+compares every file's (path, size, mtime) with the audio_file table, and then:
+- inserts new files, and gives them a split (see vampnet.db.partition)
+- marks files that are gone as deleted (and drops their control signals)
+- re-probes changed files, and drops their control signals (and past failures) so they get re-encoded
+- encodes everything that's missing a control signal (see vampnet.db.preprocess)
+- repacks the shards of the dataset, if it has any (see vampnet.db.shard)
+
+python -m vampnet.db.sync --dataset example
+"""
+import os
+from pathlib import Path
+
+import audiotools as at
+import pandas as pd
+
+import vampnet
+from vampnet.db.create import AUDIO_EXT, probe_files
+from vampnet.db.partition import partition_dataset
+from vampnet.db.preprocess import preprocess
+
+
+def sync_dataset(
+    dataset: str = None,
+    num_workers: int = 16,
+    encode: bool = True,
+    repack: bool = True,
+):
+    assert dataset is not None
+
+    conn = vampnet.db.conn(read_only=False)
+    vampnet.db.migrate_audio_file_table(conn)
+    vampnet.db.create_ctrl_sig_failure_table(conn)
+    dataset_id, root = vampnet.db.get_dataset(conn, dataset)
+    print(f"Found dataset {dataset} at {root}")
+
+    # what's on disk?
+    print(f"looking for audio files in {root}")
+    disk = []
+    for file in at.util.find_audio(Path(root), ext=AUDIO_EXT):
+        stat = os.stat(file)
+        path = str(Path(file).absolute().relative_to(Path(root).absolute()))
+        disk.append((file, path, stat.st_size, stat.st_mtime))
+    disk = pd.DataFrame(disk, columns=["file", "path", "file_size", "mtime"])
+    print(f"Found {len(disk)} audio files on disk")
+
+    # what's in the db?
+    db = conn.execute("""
+        SELECT id, path, file_size, mtime, deleted
+        FROM audio_file
+        WHERE dataset_id = ?
+    """, (dataset_id,)).df()
+    print(f"Found {len(db)} audio files in the db")
+
+    both = disk.merge(db, on="path", how="outer", suffixes=("", "_db"), indicator=True)
+    new = both[both["_merge"] == "left_only"]
+    gone = both[(both["_merge"] == "right_only") & ~both["deleted"].fillna(False).astype(bool)]
+    present = both[both["_merge"] == "both"]
+    # files that were added before we tracked stats: trust them, and just record their stats
+    untracked = present[present["file_size_db"].isna() | present["mtime_db"].isna()]
+    present = present.drop(untracked.index)
+    changed = present[
+        (present["file_size"] != present["file_size_db"])
+        | (present["mtime"] != present["mtime_db"])
+        | present["deleted"].astype(bool)  # deleted, and now back
+    ]
+    print(f"{len(new)} new, {len(changed)} changed, {len(gone)} deleted, {len(untracked)} untracked files")
+
+    # probe what we need to
+    probe = pd.concat([new, changed])
+    afs = probe_files(probe["file"].tolist(), root, dataset_id, num_workers=num_workers)
+    new_afs = [af for af in afs[:len(new)] if af is not None]
+    changed_afs = pd.DataFrame([
+        dict(id=int(audio_file_id), **af.__dict__)
+        for audio_file_id, af in zip(changed["id"], afs[len(new):]) if af is not None
+    ])
+
+    conn.sql("BEGIN TRANSACTION")
+    try:
+        vampnet.db.insert_audio_files(conn, new_afs)
+
+        if len(changed_afs) > 0:
+            conn.register("_changed_df", changed_afs)
+            # drop the stale control signals (and failures), so that preprocess re-encodes these
+            conn.execute("DELETE FROM ctrl_sig WHERE audio_file_id IN (SELECT id FROM _changed_df)")
+            conn.execute("DELETE FROM ctrl_sig_failure WHERE audio_file_id IN (SELECT id FROM _changed_df)")
+            conn.execute("""
+                UPDATE audio_file SET
+                    num_frames = c.num_frames, sample_rate = c.sample_rate, 
+                    num_channels = c.num_channels, bit_depth = c.bit_depth, encoding = c.encoding,
+                    file_size = c.file_size, mtime = c.mtime, deleted = FALSE
+                FROM _changed_df as c
+                WHERE audio_file.id = c.id
+            """)
+            conn.unregister("_changed_df")
+
+        if len(gone) > 0:
+            conn.register("_gone_df", gone[["id"]].astype({"id": "int64"}))
+            # without a control signal, they won't be sampled by VampNetDataset
+            conn.execute("DELETE FROM ctrl_sig WHERE audio_file_id IN (SELECT id FROM _gone_df)")
+            conn.execute("DELETE FROM ctrl_sig_failure WHERE audio_file_id IN (SELECT id FROM _gone_df)")
+            conn.execute("UPDATE audio_file SET deleted = TRUE WHERE id IN (SELECT id FROM _gone_df)")
+            conn.unregister("_gone_df")
+
+        if len(untracked) > 0:
+            conn.register("_untracked_df", untracked[["id", "file_size", "mtime"]].astype({"id": "int64"}))
+            conn.execute("""
+                UPDATE audio_file SET file_size = u.file_size, mtime = u.mtime
+                FROM _untracked_df as u
+                WHERE audio_file.id = u.id
+            """)
+            conn.unregister("_untracked_df")
+    except Exception:
+        conn.sql("ROLLBACK")
+        raise
+    conn.sql("COMMIT")
+    vampnet.db.manifest.clear_manifests(dataset)
+    if len(new_afs) + len(changed_afs) + len(gone) > 0:
+        # the shards still have the old control signals
+        vampnet.db.shard.mark_shards_stale(dataset)
+    print(f"synced {dataset}: inserted {len(new_afs)}, updated {len(changed_afs)}, deleted {len(gone)}")
+    print(f"of which {len(probe) - len(new_afs) - len(changed_afs)} failed to probe")
+
+    # give new files a split. existing files keep theirs
+    partition_dataset(dataset)
+    if encode:
+        # only encodes files that don't have a control signal
+        preprocess(dataset)
+
+    stale = vampnet.db.shard.stale_shards(dataset)
+    if encode and repack:
+        for name in stale:
+            vampnet.db.shard.pack_shards(dataset, name)
+    elif stale:
+        print(f"the shards of {stale} are stale, and won't load until they're repacked with vampnet.db.shard")
+
+
+if __name__ == "__main__":
+    import yapecs
+    parser = yapecs.ArgumentParser()
+
+    parser.add_argument("--dataset", type=str, default=None, help="dataset to sync")
+    parser.add_argument("--num_workers", type=int, default=16, help="number of threads probing audio files")
+    parser.add_argument("--no_encode", dest="encode", action="store_false", help="only sync the db, don't encode new and changed files")
+    parser.add_argument("--no_repack", dest="repack", action="store_false", help="don't repack stale shards (they won't load until you do)")
+
+    args = parser.parse_args()
+    sync_dataset(**vars(args))
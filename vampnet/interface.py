@@ -2,25 +2,202 @@ from audiotools import AudioSignal
 import torch
 import vampnet.mask as pmask
 from vampnet.model.transformer import VampNet
+from vampnet.controls.codec import compress, decompress
 import math
 import numpy as np
 from tqdm import tqdm
 from dac.model.dac import DAC
 import audiotools as at
 from typing import Optional
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import os
+import threading
+from concurrent.futures import Future
 
 import vampnet
 
+
+def apply_silence_mask(
+    samples: torch.Tensor, 
+    z: torch.Tensor, 
+    mask_token: int, 
+    hop_length: int
+):
+    """
+    zero out the audio for every frame where any codebook holds the mask token.
+    each batch item is masked on its own. 
+
+    Args:
+        samples (torch.Tensor): audio samples. shape (batch_size, n_channels, n_samples)
+        z (torch.Tensor): the codes the audio was decoded from. shape (batch_size, n_codebooks, seq_len)
+        mask_token (int): the mask token.
+        hop_length (int): codec hop length, in samples.
+    
+    Returns:
+        torch.Tensor: the masked samples. shape (batch_size, n_channels, n_samples)
+    """
+    keep = ~(z == mask_token).any(dim=1) # (batch_size, seq_len)
+    keep = keep.repeat_interleave(hop_length, dim=-1)
+
+    # the audio might be a bit shorter or longer than seq_len * hop_length
+    n_samples = samples.shape[-1]
+    if keep.shape[-1] < n_samples:
+        keep = torch.nn.functional.pad(keep, (0, n_samples - keep.shape[-1]), value=True)
+    keep = keep[:, None, :n_samples].to(samples.device)
+
+    return samples * keep.to(samples.dtype)
+
+
+class EncodeCache:
+    """
+    a content-addressed cache for encoded tokens. 
+    tokens are kept in an in-memory LRU with a byte budget, 
+    and optionally written to disk as .npy files, so they survive restarts. 
+    the disk tier is an LRU too, capped at max_disk_bytes.
+    """
+
+    def __init__(
+        self, 
+        max_bytes: int = 256 * 2**20, 
+        cache_dir: Optional[str] = None, 
+        max_disk_bytes: int = 4 * 2**30,
+    ):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        # what's on disk, least recently used first (key -> file size)
+        self._disk = OrderedDict()
+        self._disk_nbytes = 0
+        self._lock = threading.Lock()
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # pick up the files from previous runs, oldest first
+            files = []
+            for path in self.cache_dir.glob("*.npy"):
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, path.stem, st.st_size))
+            for _, key, size in sorted(files):
+                self._disk[key] = size
+                self._disk_nbytes += size
+            self._prune_disk()
+
+    @staticmethod
+    def key(signal: AudioSignal, codec_id: str):
+        h = hashlib.sha1()
+        h.update(codec_id.encode())
+        h.update(str(signal.sample_rate).encode())
+        samples = signal.samples.detach().cpu().contiguous()
+        h.update(str(tuple(samples.shape)).encode())
+        h.update(samples.numpy().tobytes())
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        if self.cache_dir is not None:
+            path = self.cache_dir / f"{key}.npy"
+            try:
+                z = torch.from_numpy(np.load(path))
+                # bump the mtime, so the lru order survives restarts
+                os.utime(path)
+            except (FileNotFoundError, ValueError):
+                # not cached, or pruned while we were reading it
+                return None
+            self._touch_disk(key, path.stat().st_size)
+            self._put_mem(key, z)
+            return z
+        return None
+
+    def put(self, key: str, z: torch.Tensor):
+        # tokens fit in int16, and that's 4x less memory than long
+        z = z.detach().cpu().short()
+        self._put_mem(key, z)
+        if self.cache_dir is not None and z.numel() * z.element_size() <= self.max_disk_bytes:
+            path = self.cache_dir / f"{key}.npy"
+            # write to a tmp file first, so we never read a half-written file
+            tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, z.numpy())
+            tmp_path.replace(path)
+            self._touch_disk(key, path.stat().st_size)
+            self._prune_disk()
+        return z
+
+    def _touch_disk(self, key: str, size: int):
+        with self._lock:
+            self._disk_nbytes += size - self._disk.pop(key, 0)
+            self._disk[key] = size
+
+    def _prune_disk(self):
+        # remove the least recently used files until we're within budget
+        with self._lock:
+            while len(self._disk) > 1 and self._disk_nbytes > self.max_disk_bytes:
+                key, size = self._disk.popitem(last=False)
+                self._disk_nbytes -= size
+                (self.cache_dir / f"{key}.npy").unlink(missing_ok=True)
+
+    def _put_mem(self, key: str, z: torch.Tensor):
+        nbytes = z.numel() * z.element_size()
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = z
+            self._nbytes += nbytes
+            # evict the least recently used tokens
+            while self._nbytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self._nbytes -= old.numel() * old.element_size()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+
 class Interface:
 
     def __init__(self, 
         codec: DAC, 
         model: VampNet, 
-        device=vampnet.DEVICE
+        device=vampnet.DEVICE,
+        decode_win_duration: Optional[float] = 30.0,
+        encode_win_duration: Optional[float] = 30.0,
+        encode_batch_windows: int = 4,
+        encode_cache_bytes: int = 256 * 2**20,
+        encode_cache_dir: Optional[str] = None,
+        encode_cache: Optional[EncodeCache] = None,
     ):
         self.codec = codec
         self.model = model
 
+        # decode in windows of this many seconds, to bound memory (None to decode at once)
+        self.decode_win_duration = decode_win_duration
+        # encode inputs longer than this many seconds in windows (None to encode at once), 
+        # with up to encode_batch_windows windows per encoder forward
+        self.encode_win_duration = encode_win_duration
+        self.encode_batch_windows = encode_batch_windows
+
+        # cache encoded tokens, so encoding the same audio twice is free
+        # (pass encode_cache to share one between interfaces, e.g. in a ModelPool)
+        if encode_cache is None:
+            encode_cache = EncodeCache(encode_cache_bytes, encode_cache_dir)
+        self.encode_cache = encode_cache
+
         self.device = device
         self.to(device)
 
@@ -61,17 +238,15 @@ class Interface:
         _z = codec.quantizer.from_latents(self.model.embedding.from_codes(z, codec))[0]
 
         signal = at.AudioSignal(
-            codec.decode(_z), 
+            decompress(codec, _z, self.decode_win_duration), 
             codec.sample_rate,
         )
 
         if silence_mask:
             # find where the mask token is and replace it with silence in the audio
-            for tstep in range(z.shape[-1]):
-                if torch.any(z[:, :, tstep] == self.model.special_tokens["MASK"]):
-                    sample_idx_0 = tstep * codec.hop_length
-                    sample_idx_1 = sample_idx_0 + codec.hop_length
-                    signal.samples[:, :, sample_idx_0:sample_idx_1] = 0.0
+            signal.samples = apply_silence_mask(
+                signal.samples, z, self.model.special_tokens["MASK"], codec.hop_length
+            )
 
         return signal
 
@@ -85,11 +260,60 @@ class Interface:
         )
         return signal
 
+    @property
+    def codec_id(self):
+        """
+        a fingerprint of the codec and encode settings, for the encode cache. 
+        recomputed on every call (it's cheap next to hashing the audio), 
+        so swapping or reloading the codec never serves stale tokens.
+        """
+        h = hashlib.sha1()
+        h.update(type(self.codec).__name__.encode())
+        h.update(f"{self.codec.sample_rate}-{self.codec.hop_length}".encode())
+        h.update(f"{self.encode_win_duration}".encode())
+        for q in self.codec.quantizer.quantizers:
+            h.update(q.codebook.weight.detach().cpu().float().numpy().tobytes())
+        return h.hexdigest()
+
     @torch.inference_mode()
-    def encode(self, signal: AudioSignal):
-        signal = self.preprocess(signal).to(self.device)
-        z = self.codec.encode(signal.samples, signal.sample_rate)["codes"]
+    def encode(self, signal: AudioSignal, use_cache: bool = True):
+        if use_cache:
+            key = self.encode_cache.key(signal, self.codec_id)
+            z = self.encode_cache.get(key)
+            if z is not None:
+                return z.long().to(self.device)
+
+        z = self._encode(signal)
+
+        if use_cache:
+            self.encode_cache.put(key, z)
         return z
+
+    def _encode(self, signal: AudioSignal):
+        """
+        encodes a signal to tokens of shape (batch, n_codebooks, ceil(n_samples / hop_length)), 
+        same as encoding it in one go with the codec (which right-pads to a multiple of the hop length). 
+        signals longer than encode_win_duration are encoded in windows, 
+        so a few tokens near the window edges can differ (~1%) from a one-shot encode. 
+        set encode_win_duration=None for exact one-shot tokens.
+        """
+        signal = self.preprocess(signal)
+        n_frames = math.ceil(signal.signal_length / self.codec.hop_length)
+
+        # only window if we have more than one window's worth of audio
+        win_duration = self.encode_win_duration
+        if win_duration and signal.signal_duration <= win_duration:
+            win_duration = None
+
+        z = compress(
+            self.codec, 
+            self.device, 
+            signal, 
+            win_duration=win_duration, 
+            batch_windows=self.encode_batch_windows,
+        ) # (nt, nc, nb)
+        z = z.permute(2, 1, 0).long().to(self.device)
+        return z[..., :n_frames]
     
 
     def vamp(self, 
@@ -97,16 +321,22 @@ class Interface:
         mask: torch.Tensor, 
         return_mask:bool=False, 
         gen_fn: callable=None, 
+        max_batch_size: int = 8,
         **kwargs
     ):
         """
         vamp on a sequence of codes z, given a mask. 
 
+        sequences longer than the model's max_seq_len are split into chunks. 
+        chunks of the same length are stacked along the batch dimension and
+        generated together, and chunks without any masked tokens are skipped. 
+
         Args:
             z (torch.Tensor): a sequence of codes. shape (batch_size, n_codebooks, seq_len)
             mask (torch.Tensor): a mask. shape (batch_size, n_codebooks, seq_len)
             return_mask (bool, optional): return the mask. Defaults to False.
             gen_fn (callable, optional): used for debugging only. a function to generate the codes.  Defaults to None.
+            max_batch_size (int, optional): max number of sequences to generate in a single call. a single chunk is never split, so if batch_size is bigger than this, chunks are generated one at a time. Defaults to 8.
         Returns:
             torch.Tensor: a vamped of codes. shape (batch_size, n_codebooks, seq_len)
         """
@@ -115,6 +345,7 @@ class Interface:
         mask = mask[:, : self.model.n_codebooks, :]
 
         seq_len = cz.shape[-1]
+        batch_size = cz.shape[0]
 
         # we need to split the sequence into chunks by max seq length
         # we need to split so that the sequence length is less than the max_seq_len
@@ -125,17 +356,29 @@ class Interface:
         z_chunks = torch.split(cz, chunk_len, dim=-1)
         mask_chunks = torch.split(mask, chunk_len, dim=-1)
 
+        # group the chunks that have something to vamp by length, 
+        # so that we can stack them along the batch dim
+        groups = {}
+        for idx, mask_chunk in enumerate(mask_chunks):
+            if not mask_chunk.any():
+                continue
+            groups.setdefault(mask_chunk.shape[-1], []).append(idx)
+
         gen_fn = gen_fn or self.model.generate
-        c_vamp_chunks = [
-            gen_fn(
-                codec=self.codec,
-                time_steps=chunk.shape[-1],
-                start_tokens=chunk,
-                mask=mask_chunk,
-                **kwargs,
-            )
-            for chunk, mask_chunk in tqdm(zip(z_chunks, mask_chunks), desc="vamping chunks")
-        ]
+        chunks_per_call = max(1, max_batch_size // batch_size)
+        c_vamp_chunks = list(z_chunks)
+        for length, idxs in groups.items():
+            for i in tqdm(range(0, len(idxs), chunks_per_call), desc="vamping chunks"):
+                call_idxs = idxs[i:i + chunks_per_call]
+                out = gen_fn(
+                    codec=self.codec,
+                    time_steps=length,
+                    start_tokens=torch.cat([z_chunks[j] for j in call_idxs], dim=0),
+                    mask=torch.cat([mask_chunks[j] for j in call_idxs], dim=0),
+                    **kwargs,
+                )
+                for j, c_vamp_chunk in zip(call_idxs, out.split(batch_size, dim=0)):
+                    c_vamp_chunks[j] = c_vamp_chunk
 
         # concatenate the chunks
         c_vamp = torch.cat(c_vamp_chunks, dim=-1)
@@ -252,6 +495,61 @@ class Interface:
             return sig
 
 
+    def stream_vamp(
+        self,
+        sig: AudioSignal,
+        batch_size: int = 1,
+        feedback_steps: int = 1,
+        window_s: Optional[float] = None,
+        build_mask_kwargs: dict = None,
+        vamp_kwargs: dict = None,
+    ):
+        """
+        like ez_vamp, but encodes, masks, generates and decodes one window at a time,
+        yielding the output audio for each window as soon as it's done. 
+        the mask is built per window, so prefix_s and suffix_s apply to every window.
+
+        Args:
+            sig (AudioSignal): the input signal.
+            batch_size (int, optional): number of variations to generate. Defaults to 1.
+            feedback_steps (int, optional): number of times to vamp on the output of each window. Defaults to 1.
+            window_s (Optional[float], optional): window length in seconds. capped to the model's max_seq_len. Defaults to None (max_seq_len).
+            build_mask_kwargs (dict, optional): kwargs for build_mask. Defaults to None.
+            vamp_kwargs (dict, optional): kwargs for vamp. Defaults to None.
+
+        Yields:
+            AudioSignal: the output audio for each window. shape (batch_size, 1, window samples)
+        """
+        build_mask_kwargs = build_mask_kwargs or {}
+        vamp_kwargs = dict(vamp_kwargs or {})
+        vamp_kwargs.pop("mask", None)
+        vamp_kwargs.pop("return_mask", None)
+
+        sig = self.preprocess(sig)
+
+        window_len = self.model.max_seq_len
+        if window_s is not None:
+            window_len = min(self.s2t(window_s), window_len)
+        window_samples = window_len * self.codec.hop_length
+
+        for start in range(0, sig.samples.shape[-1], window_samples):
+            window = AudioSignal(
+                sig.samples[..., start:start + window_samples], sig.sample_rate
+            )
+            loudness = window.loudness()
+
+            z = self.encode(window)
+            z = z.expand(batch_size, -1, -1)
+            for i in range(feedback_steps):
+                mask = self.build_mask(z=z, **build_mask_kwargs)
+                z = self.vamp(z, mask=mask, return_mask=False, **vamp_kwargs)
+
+            out = self.decode(z).cpu()
+            # the codec pads to a multiple of the hop length, trim it back
+            out.samples = out.samples[..., :window.samples.shape[-1]]
+            yield out.normalize(loudness)
+
+
     def plot_sig_with_mask(self, sig, mask):
         import matplotlib.pyplot as plt
         plt.figure(figsize=(10, 10))
@@ -260,4 +558,109 @@ class Interface:
         plt.subplot(2, 1, 2)
         # plot the mask (which is a matrix)
         plt.imshow(mask[0].cpu().numpy(), aspect='auto', origin='lower', cmap='gray_r')
-        plt.show()
\ No newline at end of file
+        plt.show()
+
+
+class ModelPool:
+    """
+    keeps up to `max_models` models loaded (and optionally, at most `max_bytes` 
+    worth of parameters), each wrapped in an Interface that shares a single codec 
+    and encode cache. the least recently used model gets evicted first. 
+
+    safe to use from multiple threads: concurrent requests for a model that's 
+    still loading wait for that load instead of loading it again.
+    """
+
+    def __init__(
+        self, 
+        codec: DAC, 
+        max_models: int = 2, 
+        max_bytes: Optional[int] = None,
+        device=vampnet.DEVICE,
+        encode_cache: Optional[EncodeCache] = None,
+        load_fn: callable = None,
+    ):
+        self.codec = codec
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.device = device
+        self.encode_cache = encode_cache or EncodeCache()
+        self.load_fn = load_fn or vampnet.load_model
+
+        self._interfaces = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name: str):
+        with self._lock:
+            return name in self._interfaces
+
+    def get(self, name: str) -> Interface:
+        """get an interface for the model `name`, loading it if needed."""
+        with self._lock:
+            if name in self._interfaces:
+                self._interfaces.move_to_end(name)
+                return self._interfaces[name]
+            future = self._loading.get(name)
+            is_loader = future is None
+            if is_loader:
+                future = self._loading[name] = Future()
+
+        if not is_loader:
+            return future.result()
+
+        try:
+            interface = Interface(
+                self.codec, self.load_fn(name), device=self.device, encode_cache=self.encode_cache
+            )
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(name)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._interfaces[name] = interface
+            self._loading.pop(name)
+            self._evict()
+        future.set_result(interface)
+        return interface
+
+    def preload(self, names: list):
+        """
+        load models in a background thread. returns the thread. 
+        only fills the free slots, so preloading never evicts a model that's already loaded (or loading).
+        """
+        with self._lock:
+            names = [
+                n for n in dict.fromkeys(names) 
+                if n not in self._interfaces and n not in self._loading
+            ]
+            free = self.max_models - len(self._interfaces) - len(self._loading)
+            names = names[:max(0, free)]
+        def _preload():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    print(f"could not preload model {name}: {e}")
+        thread = threading.Thread(target=_preload, daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def _nbytes(interface: Interface):
+        return sum(p.numel() * p.element_size() for p in interface.model.parameters())
+
+    def _evict(self):
+        # NOTE: must hold self._lock. always keeps the most recently used model. 
+        def over_budget():
+            if len(self._interfaces) > self.max_models:
+                return True
+            if self.max_bytes is not None:
+                return sum(self._nbytes(i) for i in self._interfaces.values()) > self.max_bytes
+            return False
+
+        while len(self._interfaces) > 1 and over_budget():
+            name, _ = self._interfaces.popitem(last=False)
+            print(f"evicted model {name}")
@@ -147,33 +147,78 @@ class CodebookEmbedding(nn.Module):
         necessary for the language model, like <MASK>.
         """
         n_codebooks = codes.shape[1]
-        latent = []
-        for i in range(n_codebooks):
-            c = codes[:, i, :]
-
-            if torch.any(codes < self.vocab_size):
-                assert codec is not None, f"Codec must be provided for codec tokens"
-                lookup_table = codec.quantizer.quantizers[i].codebook.weight
-                if hasattr(self, "special"):
-                    special_lookup = torch.cat(
-                        [self.special[tkn][i : i + 1] for tkn in self.special], dim=0
-                    )
-                    lookup_table = torch.cat([lookup_table, special_lookup], dim=0)
-
-                l = F.embedding(c, lookup_table).transpose(1, 2)
-                latent.append(l)
-            else:
-                c = c - self.vocab_size
-                assert hasattr(self, "special"), f"Special tokens must be provided"
-                special_lookup = torch.cat(
-                    [self.special[tkn][i : i + 1] for tkn in self.special], dim=0
-                )
-                l = F.embedding(c, special_lookup).transpose(1, 2)
-                latent.append(l) 
-
-        latent = torch.cat(latent, dim=1)
+        if codec is None:
+            assert not torch.any(codes < self.vocab_size), f"Codec must be provided for codec tokens"
+            assert hasattr(self, "special"), f"Special tokens must be provided"
+            # only special tokens, index into the special rows of the table
+            table = self._special_table()[:n_codebooks]
+            codes = codes - self.vocab_size
+        else:
+            table = self.lookup_table(codec)[:n_codebooks]
+
+        # offset each codebook into its own block of the flattened table,
+        # so we can look everything up in one go
+        n_rows = table.shape[1]
+        offsets = torch.arange(n_codebooks, device=codes.device) * n_rows
+        latent = F.embedding(
+            codes + offsets[None, :, None], 
+            table.reshape(-1, table.shape[-1])
+        )
+        latent = rearrange(latent, "b c t d -> b (c d) t")
         return latent
 
+    def lookup_table(self, codec):
+        """
+        the stacked lookup table for all codebooks, including the special tokens.
+        shape (n_codebooks, vocab_size + n_special, latent_dim).
+
+        the codec part of the table is cached and rebuilt whenever the 
+        codec's codebook weights change. the special tokens are cached too, 
+        unless they need gradients, in which case we rebuild them every call
+        (they're tiny) so the graph is fresh. 
+        """
+        quantizers = codec.quantizer.quantizers[:self.n_codebooks]
+        weights = [q.codebook.weight for q in quantizers]
+        codec_key = (
+            id(codec), 
+            torch.is_inference_mode_enabled(),
+            tuple((w.data_ptr(), w._version, w.device, w.dtype) for w in weights),
+        )
+
+        cache = getattr(self, "_codec_table_cache", None)
+        if cache is None or cache[0] != codec_key:
+            with torch.no_grad():
+                codec_table = torch.stack(weights, dim=0)
+            self._codec_table_cache = cache = (codec_key, codec_table)
+            self._table_cache = None
+        codec_table = cache[1]
+
+        if not hasattr(self, "special") or len(self.special) == 0:
+            return codec_table
+
+        special = list(self.special.values())
+        needs_grad = torch.is_grad_enabled() and any(p.requires_grad for p in special)
+        if needs_grad:
+            return torch.cat(
+                [codec_table, self._special_table().to(codec_table.dtype)], dim=1
+            )
+
+        table_key = (
+            codec_key, 
+            tuple((p.data_ptr(), p._version) for p in special)
+        )
+        cache = getattr(self, "_table_cache", None)
+        if cache is None or cache[0] != table_key:
+            table = torch.cat(
+                [codec_table, self._special_table().to(codec_table.dtype)], dim=1
+            )
+            self._table_cache = cache = (table_key, table)
+        return cache[1]
+
+    def _special_table(self):
+        # (n_codebooks, n_special, latent_dim)
+        return torch.stack([self.special[tkn] for tkn in self.special], dim=1)
+
     def forward(self, latents: torch.Tensor):
         """
         project a sequence of latents to a sequence of embeddings
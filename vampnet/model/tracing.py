@@ -0,0 +1,105 @@
+"""
+step tracing for VampNet.generate.
+
+register a hook on a model with `model.register_step_hook(hook)`,
+and it will get called once per sampling step with a `StepTrace`.
+when no hooks are registered, generate doesn't do any extra work.
+"""
+import json
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Union
+
+import torch
+
+
+@dataclass
+class StepTrace:
+    """
+    everything we know about a single sampling step.
+    the tensors are references to the ones used by generate, NOT copies,
+    so clone them if you need to keep them around past the hook call.
+
+    Args:
+        codebook_level (int): the codebook level being sampled.
+        step (int): the step within the current codebook level.
+        nsteps (int): the total number of steps for the current codebook level.
+        r (torch.Tensor): the schedule position for this step. shape (batch,)
+        z_masked (torch.Tensor): the tokens after this step. shape (batch, n_codebooks, seq)
+        mask (torch.Tensor): the mask after this step. shape (batch, n_infer_codebooks, seq)
+        selected_probs (torch.Tensor): probs of the sampled tokens at the current level, inf where nothing was sampled. shape (batch, seq)
+        num_to_mask (torch.Tensor): how many tokens will stay masked. shape (batch, 1)
+        elapsed (float): wall time of the step, in seconds.
+    """
+    codebook_level: int
+    step: int
+    nsteps: int
+    r: torch.Tensor
+    z_masked: torch.Tensor
+    mask: torch.Tensor
+    selected_probs: torch.Tensor
+    num_to_mask: torch.Tensor
+    elapsed: float
+
+
+def _finite_stats(x: torch.Tensor):
+    x = x[torch.isfinite(x)].float()
+    if x.numel() == 0:
+        return {"min": None, "mean": None, "max": None}
+    return {
+        "min": x.min().item(),
+        "mean": x.mean().item(),
+        "max": x.max().item()
+    }
+
+
+class StepTraceWriter:
+    """
+    a step hook that writes per-step wall time and tensor stats
+    to a jsonl file, one line per sampling step.
+
+    usage:
+        with trace_steps(model, "trace.jsonl"):
+            model.generate(...)
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a")
+        self._t0 = time.perf_counter()
+
+    def __call__(self, model, trace: StepTrace):
+        record = {
+            "time": time.perf_counter() - self._t0,
+            "codebook_level": trace.codebook_level,
+            "step": trace.step,
+            "nsteps": trace.nsteps,
+            "elapsed": trace.elapsed,
+            "r": trace.r.float().mean().item(),
+            "num_masked": int(trace.mask[:, trace.codebook_level, :].sum().item()),
+            "num_to_mask": trace.num_to_mask.flatten().tolist(),
+            "shape": list(trace.z_masked.shape),
+            "selected_probs": _finite_stats(trace.selected_probs),
+        }
+        self._file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+@contextmanager
+def trace_steps(model, path: Union[str, Path]):
+    """
+    record every sampling step of `model.generate` to a jsonl file
+    while inside the context.
+    """
+    writer = StepTraceWriter(path)
+    handle = model.register_step_hook(writer)
+    try:
+        yield writer
+    finally:
+        handle.remove()
+        writer.close()
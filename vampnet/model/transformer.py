@@ -1,5 +1,8 @@
 import logging
 import math
+import time
+from collections import OrderedDict
+from typing import Callable
 from typing import Optional
 from typing import Tuple
 from typing import Union
@@ -11,6 +14,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.hooks
 from einops import rearrange
 from x_transformers import ContinuousTransformerWrapper
 from x_transformers import Encoder
@@ -31,6 +35,7 @@ from ..util import codebook_flatten
 from ..util import codebook_unflatten
 from .layers import CodebookEmbedding
 from .layers import WNConv1d
+from .tracing import StepTrace
 
 # set the logging level to info
 logging.basicConfig(level=logging.INFO)
@@ -102,11 +107,75 @@ class VampNet(at.ml.BaseModel):
                 vocab_size * self.n_predict_codebooks,
         )
 
+        # hooks called once per sampling step in generate
+        self._step_hooks = OrderedDict()
 
+    def register_step_hook(self, hook: Callable):
+        """
+        register a hook that gets called after every sampling step in generate.
+        the hook is called as `hook(model, trace)`, where trace is a 
+        vampnet.model.tracing.StepTrace. 
+
+        Returns:
+            torch.utils.hooks.RemovableHandle: call `handle.remove()` to remove the hook.
+        """
+        handle = torch.utils.hooks.RemovableHandle(self._step_hooks)
+        self._step_hooks[handle.id] = hook
+        return handle
+
+
+    def forward(self, x, pad_mask=None, cross_x=None, cross_pad_mask=None, segment_ids=None, positions=None):
+        """
+        segment_ids (Optional[torch.Tensor]): for packed sequences, the segment of each position. 
+            shape (batch, seq). positions only attend to positions in the same segment. 
+            padding should be its own segment (e.g. 0), in which case pad_mask isn't needed.
+        positions (Optional[torch.Tensor]): boolean tensor, True where we want logits. 
+            shape (batch, seq * n_predict_codebooks), laid out like codebook_flatten. 
+            if given, only those logits are computed, and returned in the same order as `target[positions]`, 
+            with shape (n_positions, vocab_size). 
+        """
+        out = self._hidden(
+            x, pad_mask=pad_mask, cross_x=cross_x, cross_pad_mask=cross_pad_mask, segment_ids=segment_ids
+        )
+        if positions is not None:
+            return self._classify_positions(out, positions)
+
+        out = self.classifier(out)
+        out = rearrange(out, "b n d -> b d n")
+        out = rearrange(out, "b (p c) t -> b p (t c)", c=self.n_predict_codebooks)
 
-    def forward(self, x, pad_mask=None, cross_x=None, cross_pad_mask=None,):
+        return out
+
+    def forward_at(self, x, codebook_level: int, positions: torch.Tensor, cross_x=None):
+        """
+        inference forward pass that only computes logits for a single codebook level,
+        at the given positions. 
+
+        Args:
+            x (torch.Tensor): latents. shape (batch, latent_dim * n_codebooks, seq)
+            codebook_level (int): the (predicted) codebook level to get logits for.
+            positions (torch.Tensor): boolean tensor, True where we want logits. shape (batch, seq)
+            cross_x (Optional[torch.Tensor], optional): DEPRECATED. cross attention tokens. Defaults to None.
+
+        Returns:
+            torch.Tensor: logits for the selected positions, in row-major (batch, seq) order. shape (n_positions, vocab_size)
+        """
+        out = self._hidden(x, cross_x=cross_x)
+        out = out[positions.bool()]
+        return self._classify_level(out, codebook_level)
+
+    def _hidden(self, x, pad_mask=None, cross_x=None, cross_pad_mask=None, segment_ids=None):
         pad_mask = pad_mask.bool() if isinstance(pad_mask, torch.Tensor) else pad_mask
         cross_pad_mask = cross_pad_mask.bool() if isinstance(cross_pad_mask, torch.Tensor) else cross_pad_mask
+        kwargs = {}
+        if segment_ids is not None:
+            # block diagonal attention, one block per segment. 
+            # x-transformers reads a 3d mask as (heads, i, j), so ours is (batch, 1, i, j)
+            attn_mask = (segment_ids[:, :, None] == segment_ids[:, None, :])[:, None]
+            if self.num_reg_tokens > 0:
+                # the register tokens are prepended inside self.lm, and see (and are seen by) everything
+                attn_mask = F.pad(attn_mask, (self.num_reg_tokens, 0, self.num_reg_tokens, 0), value=True)
+            kwargs["attn_mask"] = attn_mask
         x = self.embedding(x)
 
         x = rearrange(x, "b d n -> b n d")
@@ -117,12 +186,49 @@ class VampNet(at.ml.BaseModel):
             x, return_mems=False, 
             mask=pad_mask, 
             context=cross_x, 
-            context_mask=cross_pad_mask
+            context_mask=cross_pad_mask,
+            **kwargs
         )
-        out = self.classifier(out)
-        out = rearrange(out, "b n d -> b d n")
-        out = rearrange(out, "b (p c) t -> b p (t c)", c=self.n_predict_codebooks)
+        return out
+
+    def _classify_positions(self, h: torch.Tensor, positions: torch.Tensor):
+        """
+        apply the classifier only where `positions` (b, (t c)) is True, one codebook level at a time, 
+        so the cost scales with the number of positions instead of the whole sequence.
+        """
+        c = self.n_predict_codebooks
+        positions = positions.bool()
+        # where each selected logit goes in the (row-major) output
+        order = positions.flatten().cumsum(0).view_as(positions) - 1
+
+        chunks = []
+        for level in range(c):
+            level_positions = positions[:, level::c]
+            chunks.append((
+                order[:, level::c][level_positions], 
+                self._classify_level(h[level_positions], level)
+            ))
+
+        out = chunks[0][1].new_empty(int(positions.sum()), self.vocab_size)
+        for idx, logits in chunks:
+            out[idx] = logits
+        return out
 
+    def _classify_level(self, h: torch.Tensor, codebook_level: int):
+        """
+        apply only the rows of the classifier that belong to `codebook_level`.
+        the classifier's outputs are laid out as (vocab, codebook), 
+        so the rows for a level are strided by n_predict_codebooks.
+        """
+        cls = self.classifier
+        rows = slice(codebook_level, None, self.n_predict_codebooks)
+        weight = cls.weight.transpose(0, 1) if cls.fan_in_fan_out else cls.weight
+        bias = cls.bias[rows] if cls.bias is not None else None
+        out = F.linear(h, weight[rows], bias)
+        if cls.r > 0 and not cls.merged:
+            out = out + (
+                cls.lora_dropout(h) @ cls.lora_A.transpose(0, 1) @ cls.lora_B[rows].transpose(0, 1)
+            ) * cls.scaling
         return out
 
 
@@ -173,6 +279,9 @@ class VampNet(at.ml.BaseModel):
         if seed is not None:
             at.util.seed(seed)
 
+        # only pay for tracing if someone is listening
+        trace = len(self._step_hooks) > 0
+
         #####################
         # resolve initial z #
         #####################
@@ -183,7 +292,7 @@ class VampNet(at.ml.BaseModel):
                 self.device
             )
 
-        logging.debug(f"created z with shape {z.shape}")
+        logging.debug("created z with shape %s", z.shape)
 
         #################
         # resolve mask #
@@ -195,7 +304,7 @@ class VampNet(at.ml.BaseModel):
         if mask.ndim == 2:
             mask = mask[:, None, :].repeat(1, z.shape[1], 1)
         orig_mask = mask
-        logging.debug(f"created mask with shape {mask.shape}")
+        logging.debug("created mask with shape %s", mask.shape)
 
         ###########
         # set up #
@@ -205,170 +314,151 @@ class VampNet(at.ml.BaseModel):
 
         # how many codebooks are we inferring vs conditioning on?
         n_infer_codebooks = self.n_codebooks - self.n_conditioning_codebooks
-        logging.debug(f"n infer codebooks: {n_infer_codebooks}")
+        logging.debug("n infer codebooks: %d", n_infer_codebooks)
 
         #################
         # begin sampling #
         #################
         # add one sampling step for each codebook level
-        logging.debug(f"initial mask: {mask}")
-        logging.debug(f"adding {n_infer_codebooks} sampling steps")
         steps = _sampling_steps + [1 for _ in range(n_infer_codebooks - len(_sampling_steps))]
         # truncate if we have too many
         steps = steps[:n_infer_codebooks]
         for codebook_level, nsteps in enumerate(steps):
 
+            # codebook_level counts the inferred codebooks, 
+            # z_masked and orig_mask also have the conditioning ones
+            abs_level = codebook_level + self.n_conditioning_codebooks
+
             # apply the orig mask to z_masked, only in the current codebook level
             # this is crucial due to the stemgen random masking we did during training
             # which ensures all upper codebooks are masked while inferring the bottom ones.
-            z_masked[:, codebook_level, :] = torch.where(
-                orig_mask[:, codebook_level, :].bool(), 
+            z_masked[:, abs_level, :] = torch.where(
+                orig_mask[:, abs_level, :].bool(), 
                 self.mask_token, 
-                z_masked[:, codebook_level, :]
+                z_masked[:, abs_level, :]
             )
 
             # how many mask tokens to begin with?
-            num_mask_tokens_at_start = (z_masked[:, codebook_level, :] == self.mask_token).sum(dim=-1)
-            logging.debug(f"num mask tokens at start: {num_mask_tokens_at_start}")
+            num_mask_tokens_at_start = (z_masked[:, abs_level, :] == self.mask_token).sum(dim=-1)
 
             for i in range(nsteps):
-                logging.debug(f"processing cb level {codebook_level} of {len(steps)}")
-                logging.debug(f"step {i} of {nsteps}")
+                if trace:
+                    t0 = self._trace_clock()
 
                 # our current schedule step
                 r = scalar_to_batch_tensor(
                     (i + 1) / nsteps, 
                     z.shape[0]
                 ).to(z.device)
-                logging.debug(f"r: {r}")
 
                 # get latents
-                # logging.debug("z_masked before forward", z_masked)
-                _debug_z_masked_before_forward = z_masked.clone()
                 latents = self.embedding.from_codes(z_masked, codec)
-                # logging.debug(f"computed latents with shape: {latents.shape}")
-
-                # infer from latents
-                # NOTE: this collapses the codebook dimension into the sequence dimension
-                logits = self.forward(
-                    latents, cross_x=cross_x
-                )  # b, prob, seq
-                logits = logits.permute(0, 2, 1)  # b, seq, prob
-                # logging.debug(f"permuted logits with shape: {logits.shape}")
-
-                sampled_z, selected_probs = sample_from_logits(
-                    logits, sample=(
-                    (i / nsteps) <= sample_cutoff
-                    ), 
-                    temperature=sampling_temperature,
-                    typical_filtering=typical_filtering, typical_mass=typical_mass,
-                    typical_min_tokens=typical_min_tokens,
-                    top_k=None, top_p=top_p, return_probs=True,
-                )
-
-                # fill selected probs with -inf if we're not in the codebook level we are sampling from
-                # find out which codebook we are sampling from
-                selected_probs = codebook_unflatten(selected_probs, n_infer_codebooks)
-                selected_probs[:,  codebook_level+1:, :,] = -float("inf") # all the ones above
-                # selected_probs[:, :codebook_level, :,] = -float("inf")
-                logging.debug(f"masking all but codebook {codebook_level}")
-                logging.debug(f"selected probs: {selected_probs}")
-                logging.debug(mask)
-                selected_probs = codebook_flatten(selected_probs)
-
-                logging.debug(f"sampled z with shape: {sampled_z.shape}")
-
-                # flatten z_masked and mask, so we can deal with the sampling logic
-                # we'll unflatten them at the end of the loop for the next forward pass
+
                 # remove conditioning codebooks, we'll add them back at the end
-                z_masked = codebook_flatten(z_masked[:, self.n_conditioning_codebooks:, :])      
-
-                mask = (z_masked == self.mask_token).int()
-                logging.debug(f"mask now: {mask}")
-                
-                # update the mask, remove conditioning codebooks from the mask
-                logging.debug(f"updated mask with shape: {mask.shape}")
-                
-                # add z back into sampled z where the mask was false
-                sampled_z = torch.where(
-                    mask.bool(), sampled_z, z_masked
-                )
-                logging.debug(f"added z back into sampled z with shape: {sampled_z.shape}")
-
-                # get the num tokens to mask, according to the schedule
-                num_to_mask = torch.floor(_gamma(r) * num_mask_tokens_at_start).unsqueeze(1).long()
-                # num_to_mask = torch.floor(r * num_mask_tokens_at_start).unsqueeze(1).long() # doesn't work at all this way
-                logging.debug(f"num to mask: {num_to_mask}")
-                logging.debug(f"masking {num_to_mask.sum()} tokens")
-
-                if i != (nsteps - 1):
-                    mask = codebook_unflatten(mask, n_infer_codebooks)
-                    num_to_mask = torch.maximum(
-                        torch.tensor(1),
-                        torch.minimum(
-                            mask[:, codebook_level, :].sum(dim=-1, keepdim=True) - 1,
-                            num_to_mask
+                z_infer = z_masked[:, self.n_conditioning_codebooks:, :]
+                mask = (z_infer == self.mask_token).int()
+
+                # we only need logits for the masked tokens in the current codebook level. 
+                # everything else is either given, or gets masked again before the next step.
+                positions = mask[:, codebook_level, :].bool()
+                if positions.any():
+                    logits = self.forward_at(
+                        latents, codebook_level, positions, cross_x=cross_x
+                    )  # n_positions, prob
+
+                    sampled_tokens, sampled_probs = sample_from_logits(
+                        logits[None], sample=(
+                        (i / nsteps) <= sample_cutoff
+                        ), 
+                        temperature=sampling_temperature,
+                        typical_filtering=typical_filtering, typical_mass=typical_mass,
+                        typical_min_tokens=typical_min_tokens,
+                        top_k=None, top_p=top_p, return_probs=True,
+                    )
+
+                    # scatter the sampled tokens back into z
+                    sampled_z = z_infer.clone()
+                    sampled_z[:, codebook_level, :][positions] = sampled_tokens[0]
+
+                    # ignore any tokens that weren't masked
+                    selected_probs = torch.full(
+                        positions.shape, torch.inf, 
+                        dtype=sampled_probs.dtype, device=sampled_probs.device
+                    )
+                    selected_probs[positions] = sampled_probs[0]
+
+                    # get the num tokens to mask, according to the schedule
+                    num_to_mask = torch.floor(_gamma(r) * num_mask_tokens_at_start).unsqueeze(1).long()
+                    # num_to_mask = torch.floor(r * num_mask_tokens_at_start).unsqueeze(1).long() # doesn't work at all this way
+
+                    if i != (nsteps - 1):
+                        num_to_mask = torch.maximum(
+                            torch.tensor(1),
+                            torch.minimum(
+                                mask[:, codebook_level, :].sum(dim=-1, keepdim=True) - 1,
+                                num_to_mask
+                            )
                         )
+
+                    # add a causal weight to the selected probs
+                    # NOTE: some experiments i did showed that this didn't help. 
+                    # set it to 0 until further eval
+                    # (the weights are over the flattened (t c) sequence, so we take our level's stride)
+                    causal_probs = torch.linspace(
+                        1, 0, z_infer.shape[-1] * n_infer_codebooks, device=z_infer.device
+                    )[codebook_level::n_infer_codebooks]
+                    causal_probs = causal_probs.repeat(z_infer.shape[0], 1)
+                    selected_probs = selected_probs + causal_probs * causal_weight
+
+                    # get our new mask, only consider probs at current level
+                    mask_cur_level = mask_by_random_topk(
+                        num_to_mask, selected_probs, mask_temperature * (1-r.unsqueeze(1))
+                    )  
+                    mask[:, codebook_level, :] = mask_cur_level
+
+                    # update the mask
+                    z_masked = torch.where(
+                        mask.bool(), self.mask_token, sampled_z
                     )
-                    logging.debug(f"will mask {num_to_mask.sum()} tokens")
-                    mask = codebook_flatten(mask)
-            
-                # ignore any tokens that weren't masked
-                selected_probs = torch.where(
-                    mask.bool(), selected_probs, torch.inf
-                )
-
-                # add a causal weight to the selected probs
-                # NOTE: some experiments i did showed that this didn't help. 
-                # set it to 0 until further eval
-                causal_probs = torch.linspace(1, 0, z_masked.shape[-1], device=z_masked.device)
-                causal_probs = causal_probs.repeat(z_masked.shape[0], 1)
-                selected_probs = selected_probs + causal_probs * causal_weight
-
-                # # get our new mask
-                ############
-                mask = codebook_unflatten(mask, n_infer_codebooks)
-                selected_probs = codebook_unflatten(selected_probs, n_infer_codebooks)
-
-                # only consider probs at current level
-                selected_probs_cur_level = selected_probs[:, codebook_level, :]
-                mask_cur_level = mask_by_random_topk(
-                    num_to_mask, selected_probs_cur_level, mask_temperature * (1-r.unsqueeze(1))
-                )  
-                mask[:, codebook_level, :] = mask_cur_level
-
-                mask = codebook_flatten(mask)
-                selected_probs = codebook_flatten(selected_probs)
-                ###############
-
-                # update the mask
-                z_masked = torch.where(
-                    mask.bool(), self.mask_token, sampled_z
-                )
-                logging.debug(f"updated z_masked with shape: {z_masked.shape}")
-
-                z_masked = codebook_unflatten(z_masked, n_infer_codebooks)
-                mask = codebook_unflatten(mask, n_infer_codebooks)
-                logging.debug(f"unflattened z_masked with shape: {z_masked.shape}")
-
-                # add conditioning codebooks back to z_masked
-                z_masked = torch.cat(
-                    (z[:, :self.n_conditioning_codebooks, :], z_masked), dim=1
-                )
-                logging.debug(f"added conditioning codebooks back to z_masked with shape: {z_masked.shape}")
-                logging.debug(f"\n\n\n")
-
-        # add conditioning codebooks back to sampled_z
-        sampled_z = codebook_unflatten(sampled_z, n_infer_codebooks)
-        sampled_z = torch.cat(
-            (z[:, :self.n_conditioning_codebooks, :], sampled_z), dim=1
-        )
 
-        logging.debug(f"finished sampling")
+                    # add conditioning codebooks back to z_masked
+                    z_masked = torch.cat(
+                        (z[:, :self.n_conditioning_codebooks, :], z_masked), dim=1
+                    )
+                else:
+                    # nothing left to sample at this level, 
+                    # but the step still counts (and hooks still see it)
+                    selected_probs = torch.full(positions.shape, torch.inf, device=z.device)
+                    num_to_mask = torch.zeros(z.shape[0], 1, dtype=torch.long, device=z.device)
+
+                if trace:
+                    step_trace = StepTrace(
+                        codebook_level=codebook_level,
+                        step=i,
+                        nsteps=nsteps,
+                        r=r,
+                        z_masked=z_masked,
+                        mask=mask,
+                        selected_probs=selected_probs,
+                        num_to_mask=num_to_mask,
+                        elapsed=self._trace_clock() - t0,
+                    )
+                    for hook in self._step_hooks.values():
+                        hook(self, step_trace)
+
+        # all masked tokens have been sampled by now
+        sampled_z = z_masked
 
+        logging.debug("finished sampling")
 
         return sampled_z
 
+    def _trace_clock(self):
+        # wait for queued kernels so step timings are real
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
 
 def sample_from_logits(
         logits, 
@@ -466,27 +556,16 @@ def mask_by_random_topk(
         probs (torch.Tensor): probabilities for each sampled event, shape (batch, seq)
         temperature (float, optional): temperature. Defaults to 1.0.
     """
-    logging.debug(f"masking by random topk")
-    logging.debug(f"num to mask: {num_to_mask}")
-    logging.debug(f"probs shape: {probs.shape}")
-    logging.debug(f"temperature: {temperature}")
-    logging.debug("")
-
     noise = gumbel_noise_like(probs)
     confidence = torch.log(probs) + temperature * noise
-    logging.debug(f"confidence shape: {confidence.shape}")
 
     sorted_confidence, sorted_idx = confidence.sort(dim=-1)
-    logging.debug(f"sorted confidence shape: {sorted_confidence.shape}")
-    logging.debug(f"sorted idx shape: {sorted_idx.shape}")
 
     # get the cut off threshold, given the mask length
     cut_off = torch.take_along_dim(sorted_confidence, num_to_mask, axis=-1)
-    logging.debug(f"cut off shape: {cut_off.shape}")
 
     # mask out the tokens
     mask = confidence < cut_off
-    logging.debug(f"mask shape: {mask.shape}")
 
     return mask
 
@@ -529,6 +608,50 @@ def gumbel_sample(t, temperature=1.0, dim=-1):
     return ((t / max(temperature, 1e-10)) + gumbel_noise_like(t)).argmax(dim=dim)
 
 
+def test_packed_attention():
+    # packed rows (with different segment layouts per batch item) should give
+    # the same logits as running each segment on its own
+    torch.manual_seed(0)
+    n_codebooks = 4
+    # batch size != heads, and batch size == heads
+    for n_heads, batch_size in [(2, 3), (2, 2)]:
+        model = VampNet(
+            n_heads=n_heads, n_layers=2, n_codebooks=n_codebooks, n_conditioning_codebooks=0, 
+            latent_dim=8, embedding_dim=32, vocab_size=64, dropout=0.0, max_seq_len=64, 
+            num_reg_tokens=0, cross_attend_dim=0,
+        ).eval()
+
+        layouts = [[15, 20, 5], [40], [10, 10, 10, 10]][:batch_size]
+        x = torch.randn(batch_size, 8 * n_codebooks, 40)
+        segment_ids = torch.stack([
+            torch.cat([torch.full((n,), i + 1) for i, n in enumerate(layout)]) 
+            for layout in layouts
+        ])
+
+        with torch.no_grad():
+            out = model(x, segment_ids=segment_ids)
+            for b, layout in enumerate(layouts):
+                start = 0
+                for n in layout:
+                    ref = model(x[b:b+1, :, start:start + n])
+                    got = out[b:b+1, :, start * n_codebooks:(start + n) * n_codebooks]
+                    assert torch.allclose(got, ref, atol=1e-5), (n_heads, batch_size, b, (got - ref).abs().max())
+                    start += n
+
+    # register tokens see the whole row, so we only check that they run
+    model = VampNet(
+        n_heads=2, n_layers=1, n_codebooks=n_codebooks, latent_dim=8, embedding_dim=32, 
+        vocab_size=64, max_seq_len=64, num_reg_tokens=4, cross_attend_dim=0,
+    ).eval()
+    with torch.no_grad():
+        assert model(x, segment_ids=segment_ids).shape == (batch_size, 64, 40 * n_codebooks)
+
+
+if __name__ == "__main__":
+    test_packed_attention()
+    print("packed attention tests passed")
+
+
 # if __name__ == "__main__":
 #     import argbind
 #     # from .layers import num_params
@@ -72,10 +72,11 @@ class State:
 
 
 def preprocess(state: State, accel, batch: dict, stage: str):
-    z_in = batch["codes"]
-    z_out = batch["codes"]
+    # compact batches arrive as int16, widen them now that they're on the device
+    z_in = batch["codes"].long()
+    z_out = z_in
     z_cond = batch["ctrls"]
-    ctx_mask = batch["ctx_mask"]
+    ctx_mask = batch["ctx_mask"].long()
 
     # if z_cond is a list of Nones, let's make it a single None
     if z_cond is not None and all([z is None for z in z_cond]):
@@ -96,6 +97,9 @@ def train_loop(state: State, batch: dict, accel: at.ml.Accelerator):
     output = {}
     vn = accel.unwrap(state.model)
     dtype = torch.float16 if accel.amp else None
+
+    # how much of the batch is real data (vs padding)
+    output["other/packing_efficiency"] = ctx_mask.float().mean()
         
     with accel.autocast(dtype=dtype):
 
@@ -109,8 +113,6 @@ def train_loop(state: State, batch: dict, accel: at.ml.Accelerator):
         z_mask_latent = vn.embedding.from_codes(z_mask, state.codec)
 
         # TODO: need to run z cond through and embedding model AND CLIP THE RANGE TO (0, 1) for the dataset
-        z_hat = state.model(z_mask_latent, pad_mask=ctx_mask, cross_x=z_cond, cross_pad_mask=ctx_mask)
-
         target = codebook_flatten(
             z_out[:, vn.n_conditioning_codebooks :, :],
         )
@@ -119,29 +121,37 @@ def train_loop(state: State, batch: dict, accel: at.ml.Accelerator):
         # mask is 1 where there is generated data, 0 where there is real data
         # we want the loss mask to be 1 where we infer and 0 where we condition
         # loss mask = ctx_mask & mask
-        ctx_mask = ctx_mask.unsqueeze(1).repeat_interleave(vn.n_predict_codebooks, dim=1)
+        flat_ctx_mask = ctx_mask.unsqueeze(1).repeat_interleave(vn.n_predict_codebooks, dim=1)
         if state.compute_loss_on_masked_tokens_only:
             loss_mask = codebook_flatten(
                 torch.logical_and(
                     mask[:, vn.n_conditioning_codebooks :, :].bool(),
-                    ctx_mask,
+                    flat_ctx_mask,
                 )
             )
         else:
-            loss_mask = codebook_flatten(ctx_mask)
-
-        # add the ignore indices mask to the loss mask
-        loss_mask = ~loss_mask
-        loss_mask = loss_mask | codebook_flatten(ignore_indices_mask)
+            loss_mask = codebook_flatten(flat_ctx_mask)
+
+        # leave out the ignore indices
+        loss_mask = loss_mask & ~codebook_flatten(ignore_indices_mask).bool()
+
+        # only compute logits where there is a loss, 
+        # so the classifier (and the logits' memory) scales with the number of masked tokens
+        # packed batches keep attention within each segment (padding is a segment of its own)
+        segment_ids = batch.get("segment_ids")
+        z_hat = state.model(
+            z_mask_latent, 
+            pad_mask=ctx_mask if segment_ids is None else None, 
+            cross_x=z_cond, cross_pad_mask=ctx_mask,
+            segment_ids=segment_ids,
+            positions=loss_mask,
+        )
 
-        # replace target with ignore index for masked tokens
-        t_masked = target.masked_fill(loss_mask, vampnet.IGNORE_INDEX)
-        output["loss"] = state.criterion(z_hat, t_masked)
-        _metrics(
-            r=r,
+        output["loss"] = state.criterion(z_hat, target[loss_mask])
+        _masked_metrics(
+            r=r[:, None].expand_as(loss_mask)[loss_mask],
             z_hat=z_hat,
-            target=target,
-            flat_mask=~loss_mask,
+            target=target[loss_mask],
             output=output,
         )
 
@@ -187,7 +197,14 @@ def val_loop(state: State, batch: dict, accel: at.ml.Accelerator):
 
         z_mask_latent = vn.embedding.from_codes(z_mask, state.codec)
 
-        z_hat = state.model(z_mask_latent, pad_mask=ctx_mask, cross_x=z_cond, cross_pad_mask=ctx_mask)
+        # packed batches keep attention within each segment (padding is a segment of its own)
+        segment_ids = batch.get("segment_ids")
+        z_hat = state.model(
+            z_mask_latent, 
+            pad_mask=ctx_mask if segment_ids is None else None, 
+            cross_x=z_cond, cross_pad_mask=ctx_mask,
+            segment_ids=segment_ids,
+        )
 
         target = codebook_flatten(
             z_out[:, vn.n_conditioning_codebooks :, :],
@@ -582,13 +599,20 @@ def train(accel: at.ml.Accelerator,
     val_batch_size = min(val_batch_size, len(state.val_data))
     print(f"trimmed val batch size: {val_batch_size}")
 
+    # page-locked batches copy to the gpu faster
+    pin_memory = torch.device(accel.device).type == "cuda"
     train_dataloader = accel.prepare_dataloader(
         state.train_data,
-        start_idx=state.tracker.step * batch_size,
         num_workers=num_workers,
         batch_size=batch_size,
         collate_fn=state.train_data.collate,
         prefetch_factor=2 if num_workers > 0 else None,
+        pin_memory=pin_memory,
+    )
+    # if we're resuming, skip the batches of the current epoch we've already seen
+    # (the sampler counts this rank's samples, and goes back to 0 for the next epoch)
+    train_dataloader.sampler.start_idx = (
+        (state.tracker.step % len(train_dataloader)) * train_dataloader.batch_size
     )
     val_dataloader = accel.prepare_dataloader(
         state.val_data,
@@ -597,6 +621,7 @@ def train(accel: at.ml.Accelerator,
         batch_size=val_batch_size,
         collate_fn=state.val_data.collate,
         prefetch_factor=2 if num_workers > 0 else None,
+        pin_memory=pin_memory,
     )
     print("initialized dataloader.")
 
@@ -621,47 +646,101 @@ def train(accel: at.ml.Accelerator,
     # first_iter = True
     with tracker.live:
         print(f"tracker opened")
-        done = False
-
-        while not done:
-            for tracker.step, batch in enumerate(train_dataloader, start=tracker.step): 
-                train_loop(state, batch, accel)
-                    
-                last_iter = (
-                    tracker.step == num_iters - 1 if num_iters is not None else False
-                )
 
-                # if tracker.step == 0 or first_iter:
-                #     first_iter = False
-                #     continue
-
-                if tracker.step % val_freq == 0 or last_iter:
-                    tracker.print(f"Validating at iteration {tracker.step}")
-                    validate(state, val_dataloader, accel)
-
-                    print(f"Saving checkpoint at iteration {tracker.step}")
-                    checkpoint(
-                        state=state, 
-                        save_iters=save_iters,
-                        save_path=save_path, 
-                        fine_tune=fine_tune)
-                    print(f"checkpoint done")
-
-                if tracker.step % sample_freq == 0 or last_iter:
-                    tracker.print(f"Saving samples at iteration {tracker.step}")
-                    save_samples(state, val_idx, writer)
-
-                    # Reset validation progress bar, print summary since last validation.
-                    tracker.done("val", f"Iteration {tracker.step}")
-
-                if last_iter:
-                    print(f"Finished training at iteration {tracker.step}")
-                    done = True
-                    break
+        for tracker.step, batch in _passes(state.train_data, train_dataloader, tracker.step):
+            train_loop(state, batch, accel)
+                
+            last_iter = (
+                tracker.step == num_iters - 1 if num_iters is not None else False
+            )
+
+            # if tracker.step == 0 or first_iter:
+            #     first_iter = False
+            #     continue
+
+            if tracker.step % val_freq == 0 or last_iter:
+                tracker.print(f"Validating at iteration {tracker.step}")
+                validate(state, val_dataloader, accel)
+
+                print(f"Saving checkpoint at iteration {tracker.step}")
+                checkpoint(
+                    state=state, 
+                    save_iters=save_iters,
+                    save_path=save_path, 
+                    fine_tune=fine_tune)
+                print(f"checkpoint done")
+
+            if tracker.step % sample_freq == 0 or last_iter:
+                tracker.print(f"Saving samples at iteration {tracker.step}")
+                save_samples(state, val_idx, writer)
+
+                # Reset validation progress bar, print summary since last validation.
+                tracker.done("val", f"Iteration {tracker.step}")
+
+            if last_iter:
+                print(f"Finished training at iteration {tracker.step}")
+                break
         
     # return an interface with the codec and model
     return state.interface
 
+
+def _passes(train_data: VampNetDataset, train_dataloader, step: int):
+    """
+    yields (step, batch) forever, one pass over the dataloader after another, 
+    starting at `step` (e.g. when resuming). 
+    the dataset draws its windows from (seed, epoch, idx), so before each pass 
+    we tell it which epoch it is: every pass gets new windows, 
+    and a resumed run picks up the same windows where it left off.
+    """
+    steps_per_epoch = len(train_dataloader)
+    epoch = step // steps_per_epoch
+    while True:
+        train_data.set_epoch(epoch)
+        for batch in train_dataloader:
+            yield step, batch
+            step += 1
+        epoch += 1
+
+def test_passes():
+    # python -c "import vampnet.train; vampnet.train.test_passes()"
+    import itertools
+    import numpy as np
+    from vampnet.db.data import AliasTable
+
+    class Dataset(VampNetDataset):
+        # just enough of a weighted dataset to locate windows, without a db
+        def __init__(self):
+            self.sampling, self.seed, self.epoch, self.seq_len = "weighted", 0, 0, 100
+            self.num_frames = np.array([1000, 250, 5000, 40])
+            self.alias_table = AliasTable(self.num_frames)
+            self.epochs = []
+
+        def set_epoch(self, epoch):
+            self.epochs.append(epoch)
+            super().set_epoch(epoch)
+
+    steps_per_epoch = 5
+    loader = list(range(steps_per_epoch))
+
+    # every pass is a new epoch, and steps keep counting across passes
+    data = Dataset()
+    draws = []
+    for step, batch in itertools.islice(_passes(data, loader, 0), 4 * steps_per_epoch):
+        assert step == len(draws)
+        draws.append([data.locate(i)[:2] for i in range(20)])
+    assert data.epochs == [0, 1, 2, 3], data.epochs
+    for epoch in range(3):
+        a, b = draws[epoch * steps_per_epoch], draws[(epoch + 1) * steps_per_epoch]
+        assert a != b, f"epochs {epoch} and {epoch + 1} drew the same windows"
+
+    # resuming mid-way through the second epoch picks up in that epoch
+    data = Dataset()
+    step, _ = next(_passes(data, loader, 7))
+    assert step == 7 and data.epochs == [1], (step, data.epochs)
+    assert [data.locate(i)[:2] for i in range(20)] == draws[steps_per_epoch]
+
+
 def accuracy(
     preds: torch.Tensor,
     target: torch.Tensor,
@@ -692,6 +771,26 @@ def accuracy(
     return accuracy
 
 
+def _masked_metrics(z_hat, r, target, output):
+    """
+    like _metrics, but for logits that were only computed at the masked positions 
+    (see VampNet.forward's `positions`), so there's no unmasked accuracy.
+    z_hat is (n, vocab), r and target are (n,)
+    """
+    for r_range in [(0, 0.5), (0.5, 1.0)]:
+        r_idx = (r >= r_range[0]) & (r < r_range[1])
+
+        for topk in (25,):
+            s, e = r_range
+            tag = f"accuracy-{s}-{e}/top{topk}"
+
+            output[f"{tag}/masked"] = accuracy(
+                preds=z_hat[r_idx].T[None],
+                target=target[r_idx][None],
+                top_k=topk,
+            )
+
+
 def _metrics(z_hat, r, target, flat_mask, output):
     for r_range in [(0, 0.5), (0.5, 1.0)]:
         unmasked_target = target.masked_fill(flat_mask.bool(), vampnet.IGNORE_INDEX)